@@ -7,6 +7,31 @@ int speed=300;
 const int servoPins[18] = {2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 20, 21};
 char command; 
 char direction='a';
+
+// Framed command protocol, see final_flask/protocol.py
+const byte FRAME_SOF = 0xA5;
+const byte MAX_PAYLOAD = 32;
+const unsigned long FRAME_TIMEOUT_MS = 50;
+const byte ACK_OK = 0;
+const byte ACK_UNKNOWN_TYPE = 1;
+const byte ACK_BAD_PAYLOAD = 2;
+byte frameBuf[MAX_PAYLOAD + 4];
+byte frameLen = 0;
+bool inFrame = false;
+unsigned long frameStart = 0;
+// Set while the host streams poses ('P' and 'J' frames); the built-in gaits
+// stand aside until the next direction command
+bool streaming = false;
+// Set when a command switches direction, so the running gait cycle stops
+// at its next step instead of finishing first
+bool directionChanged = false;
+// Femurs of tripod B (L2, R1, R3), which sit at 180 while those legs are lifted
+const byte TRIPOD_B_FEMURS[3] = {4, 10, 16};
+// Set by the first valid frame. From then on the host speaks only frames, so
+// bytes outside one are the remains of a broken frame (pose angles are often
+// 'F', 'L' or 'S'), never bare commands.
+bool framedLink = false;
+const byte MAX_ANGLE = 180;
 // Define the initial angles for each servo
 const int initialAngles[18] = {
   90, 158, 145, // L1, L2, L3
@@ -41,46 +66,9 @@ void setup() {
 
 void loop() {
 
-  if (Serial1.available()) {
-    String data  = Serial1.readString();
-    // Trim leading and trailing whitespace from the received data
-    data.trim();
-
-    Serial.println("data"+data);
-    Serial.println(data.length());
-    // Process each character in the data string
-    for (int i = 0; i < data.length(); i++) {
-      char command = data.charAt(i);
-      Serial.println(command);
-      switch(command) {
-        case 'F':
-          direction = 'F';
-          Serial.println("Forward");
-          break;
-        case 'B':
-          direction='B';
-          Serial.println("Backward");
-          break;
-        case 'L':
-          direction='L';
-          Serial.println("Left");
-          break;
-        case 'R':
-          direction='R';
-          Serial.println("Right");
-          break;
-        case 'S':
-          direction='S';
-          break;
-        default:
-          direction='S';
-          // Handle unexpected characters
-          Serial.print("Unknown command: ");
-          // Serial.println(command);
-          break;
-      }
-    }
-  }
+  // Handle any commands that arrived, then run one cycle of the current gait
+  pollSerial();
+  directionChanged = false;
   switch(direction){
         case 'F':
           move_forward();
@@ -101,6 +89,230 @@ void loop() {
   }
 }
 
+// Apply a single-letter direction command. Returns false if it is unknown.
+bool setDirection(char command) {
+  Serial.println(command);
+  streaming = false;
+  if (command != direction) {
+    directionChanged = true;
+  }
+  switch(command) {
+    case 'F':
+      direction = 'F';
+      Serial.println("Forward");
+      return true;
+    case 'B':
+      direction='B';
+      Serial.println("Backward");
+      return true;
+    case 'L':
+      direction='L';
+      Serial.println("Left");
+      return true;
+    case 'R':
+      direction='R';
+      Serial.println("Right");
+      return true;
+    case 'S':
+      direction='S';
+      return true;
+    default:
+      direction='S';
+      // Handle unexpected characters
+      Serial.print("Unknown command: ");
+      Serial.println(command);
+      return false;
+  }
+}
+
+bool isDirection(byte b) {
+  return b == 'F' || b == 'B' || b == 'L' || b == 'R' || b == 'S';
+}
+
+byte crc8(const byte *data, byte len) {
+  byte crc = 0;
+  for (byte i = 0; i < len; i++) {
+    crc ^= data[i];
+    for (byte bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+void sendFrame(byte seq, byte type, const byte *payload, byte len) {
+  byte body[MAX_PAYLOAD + 3];
+  body[0] = len;
+  body[1] = seq;
+  body[2] = type;
+  for (byte i = 0; i < len; i++) {
+    body[3 + i] = payload[i];
+  }
+  Serial1.write(FRAME_SOF);
+  Serial1.write(body, len + 3);
+  Serial1.write(crc8(body, len + 3));
+}
+
+void sendAck(byte seq, byte status) {
+  sendFrame(seq, 'A', &status, 1);
+}
+
+void handleFrame(byte seq, byte type, const byte *payload, byte len) {
+  switch(type) {
+    case 'D':
+      if (len == 1 && setDirection(payload[0])) {
+        sendAck(seq, ACK_OK);
+      } else {
+        sendAck(seq, ACK_BAD_PAYLOAD);
+      }
+      break;
+    case 'P':
+      if (len == 18 && applyPose(payload)) {
+        sendAck(seq, ACK_OK);
+      } else {
+        sendAck(seq, ACK_BAD_PAYLOAD);
+      }
+      break;
+    case 'J':
+      if (len >= 3 && applyJoints(payload, len)) {
+        sendAck(seq, ACK_OK);
+      } else {
+        sendAck(seq, ACK_BAD_PAYLOAD);
+      }
+      break;
+    default:
+      sendAck(seq, ACK_UNKNOWN_TYPE);
+      break;
+  }
+}
+
+// Write one streamed pose, one angle per servo. Returns false if any angle
+// is out of range, in which case nothing moves.
+bool applyPose(const byte *angles) {
+  for (int i = 0; i < 18; i++) {
+    if (angles[i] > MAX_ANGLE) {
+      return false;
+    }
+  }
+  streaming = true;
+  direction = 'S';
+  for (int i = 0; i < 18; i++) {
+    servos[i].write(angles[i]);
+  }
+  return true;
+}
+
+// Write only the servos in a joint-delta frame: a 3-byte mask of servo
+// numbers (LSB first), then one angle per set bit. The rest hold still.
+bool applyJoints(const byte *payload, byte len) {
+  unsigned long mask = payload[0] | ((unsigned long)payload[1] << 8) | ((unsigned long)payload[2] << 16);
+  byte count = 0;
+  for (int i = 0; i < 18; i++) {
+    if (mask & (1UL << i)) {
+      if (3 + count >= len || payload[3 + count] > MAX_ANGLE) {
+        return false;
+      }
+      count++;
+    }
+  }
+  if (3 + count != len) {
+    return false;
+  }
+  streaming = true;
+  direction = 'S';
+  count = 0;
+  for (int i = 0; i < 18; i++) {
+    if (mask & (1UL << i)) {
+      servos[i].write(payload[3 + count++]);
+    }
+  }
+  return true;
+}
+
+// Read whatever is waiting on Serial1 without blocking. Frames are
+// dispatched the moment their last byte arrives; until the first frame,
+// bare direction letters outside a frame are treated as legacy commands and
+// any other byte is ignored.
+void pollSerial() {
+  while (Serial1.available()) {
+    byte b = Serial1.read();
+    if (!inFrame) {
+      if (b == FRAME_SOF) {
+        inFrame = true;
+        frameLen = 0;
+        frameStart = millis();
+      } else if (!framedLink && isDirection(b)) {
+        setDirection(b);
+      }
+      continue;
+    }
+
+    // frameBuf holds LEN, SEQ, TYPE, PAYLOAD..., CRC
+    frameBuf[frameLen++] = b;
+    if (frameBuf[0] > MAX_PAYLOAD) {
+      inFrame = false;
+      continue;
+    }
+    if (frameLen == frameBuf[0] + 4) {
+      inFrame = false;
+      if (crc8(frameBuf, frameLen - 1) != frameBuf[frameLen - 1]) {
+        sendFrame(frameBuf[1], 'N', NULL, 0);
+        continue;
+      }
+      framedLink = true;
+      handleFrame(frameBuf[1], frameBuf[2], frameBuf + 3, frameBuf[0]);
+    }
+  }
+
+  // Drop a frame that stalled half way so the next SOF can resync
+  if (inFrame && millis() - frameStart > FRAME_TIMEOUT_MS) {
+    inFrame = false;
+  }
+}
+
+// Wait between gait steps while still servicing the command link. Returns
+// false once the host has taken over with pose frames or switched
+// direction, so the gait stops mid-cycle and the next loop() acts on it.
+// A stop, or a gait left with tripod B in the air, is settled first: every
+// gait starts by lifting tripod A, which would leave no legs down.
+bool stepDelay(int ms) {
+  unsigned long start = millis();
+  while (millis() - start < (unsigned long)ms) {
+    pollSerial();
+    if (streaming) {
+      return false;
+    }
+    if (directionChanged) {
+      if (direction == 'S' || tripodBLifted()) {
+        settle();
+      }
+      return false;
+    }
+  }
+  return true;
+}
+
+bool tripodBLifted() {
+  for (int i = 0; i < 3; i++) {
+    if (servos[TRIPOD_B_FEMURS[i]].read() == 180) {
+      return true;
+    }
+  }
+  return false;
+}
+
+// Put every leg down in the standing pose and give the servos one step's
+// time to get there
+void settle() {
+  for (int i = 0; i < 18; i++) {
+    servos[i].write(initialAngles[i]);
+  }
+  unsigned long start = millis();
+  while (millis() - start < (unsigned long)speed) {
+    pollSerial();
+  }
+}
+
 void move_forward() {
   // Step 1
   servos[1].write(180);
@@ -109,14 +321,14 @@ void move_forward() {
   servos[8].write(90);
   servos[13].write(180);
   servos[14].write(90);
-  delay(speed);
+  if (!stepDelay(speed)) return;
   Serial.println("step1");
 
   // Step 2
   servos[0].write(120);
   servos[6].write(120);
   servos[12].write(60);
-  delay(speed);
+  if (!stepDelay(speed)) return;
   Serial.println("step2");
 
   // Step 3
@@ -126,7 +338,7 @@ void move_forward() {
   servos[8].write(140);
   servos[13].write(150);
   servos[14].write(140);
-  delay(speed);
+  if (!stepDelay(speed)) return;
   Serial.println("step3");
 
   // Step 4
@@ -139,7 +351,7 @@ void move_forward() {
   servos[11].write(90);
   servos[16].write(180);
   servos[17].write(90);
-  delay(speed);
+  if (!stepDelay(speed)) return;
   Serial.println("step4");
 
 
@@ -147,7 +359,7 @@ void move_forward() {
   servos[3].write(120);
   servos[9].write(60);
   servos[15].write(60);
-  delay(speed);
+  if (!stepDelay(speed)) return;
   Serial.println("step5");
 
 
@@ -158,7 +370,7 @@ void move_forward() {
   servos[11].write(150);
   servos[16].write(165);
   servos[17].write(145);
-  delay(speed);
+  if (!stepDelay(speed)) return;
   Serial.println("step6");
 
 
@@ -184,13 +396,13 @@ void move_backward() {
   servos[8].write(90);
   servos[13].write(180);
   servos[14].write(90);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 2
   servos[0].write(60);
   servos[6].write(60);
   servos[12].write(120);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 3
   servos[1].write(158);
@@ -199,7 +411,7 @@ void move_backward() {
   servos[8].write(140);
   servos[13].write(150);
   servos[14].write(140);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 4
   servos[0].write(90);
@@ -211,13 +423,13 @@ void move_backward() {
   servos[11].write(90);
   servos[16].write(180);
   servos[17].write(90);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 5
   servos[3].write(60);
   servos[9].write(130);
   servos[15].write(120);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 6
   servos[4].write(160);
@@ -226,7 +438,7 @@ void move_backward() {
   servos[11].write(150);
   servos[16].write(165);
   servos[17].write(145);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 7
   servos[3].write(90);
@@ -249,13 +461,13 @@ void turn_left() {
   servos[8].write(90);
   servos[13].write(180);
   servos[14].write(90);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 2
   servos[0].write(60);
   servos[6].write(60);
   servos[12].write(60);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 3
   servos[1].write(158);
@@ -264,7 +476,7 @@ void turn_left() {
   servos[8].write(140);
   servos[13].write(150);
   servos[14].write(140);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 4
   servos[0].write(90);
@@ -276,13 +488,13 @@ void turn_left() {
   servos[11].write(90);
   servos[16].write(180);
   servos[17].write(90);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 5
   servos[3].write(60);
   servos[9].write(60);
   servos[15].write(60);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 6
   servos[4].write(160);
@@ -291,7 +503,7 @@ void turn_left() {
   servos[11].write(150);
   servos[16].write(165);
   servos[17].write(145);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 7
   servos[3].write(90);
@@ -314,13 +526,13 @@ void turn_right() {
   servos[8].write(90);
   servos[13].write(180);
   servos[14].write(90);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 2
   servos[0].write(120);
   servos[6].write(120);
   servos[12].write(120);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 3
   servos[1].write(158);
@@ -329,7 +541,7 @@ void turn_right() {
   servos[8].write(140);
   servos[13].write(150);
   servos[14].write(140);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 4
   servos[0].write(90);
@@ -341,13 +553,13 @@ void turn_right() {
   servos[11].write(90);
   servos[16].write(180);
   servos[17].write(90);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 5
   servos[3].write(120);
   servos[9].write(120);
   servos[15].write(120);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 6
   servos[4].write(160);
@@ -356,7 +568,7 @@ void turn_right() {
   servos[11].write(150);
   servos[16].write(165);
   servos[17].write(145);
-  delay(speed);
+  if (!stepDelay(speed)) return;
 
   // Step 7
   servos[3].write(90);
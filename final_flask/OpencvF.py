@@ -1,57 +1,108 @@
+import os
 import cv2
 import time
-import numpy as np
-from threading import Thread, Lock
+from threading import Lock
 from flask import Flask, Response, request, jsonify
 from flask_basicauth import BasicAuth
+from camera import WebcamVideoStream as BaseVideoStream, as_image, camera_source
+from detection import DetectionWorker, DetectorPipeline, DetectionEvents, PooledDetector
+from tracking import FaceTracker
+from motion import MotionGate
+from vision_pool import CascadeDetector, ProcessDetectionWorker
+from encoder import get_shared_encoder, stop_shared_encoder, mjpeg_stream, draw_boxes
+from adaptive import is_local_client
+from serial_worker import SerialWorker
+from scheduler import MotionScheduler
+from follow import FaceFollower
 
 # Optimized Webcam class with face detection
-class WebcamVideoStream:
-    def __init__(self, src=0, detect_faces=True):
-        print("Initializing camera...")
-        self.stream = cv2.VideoCapture(src)
-        
-        # Aggressive camera optimization settings
-        self.stream.set(cv2.CAP_PROP_BUFFERSIZE, 1)      # Minimum buffer size
-        self.stream.set(cv2.CAP_PROP_FRAME_WIDTH, 640)   # Reasonable resolution
-        self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)  
-        self.stream.set(cv2.CAP_PROP_FPS, 30)            # Target FPS
-        
-        # Try to disable auto focus which can cause periodic delays
-        self.stream.set(cv2.CAP_PROP_AUTOFOCUS, 0)
-        
-        # For some cameras, lower quality can reduce latency
-        self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
-        
-        self.grabbed, self.frame = self.stream.read()
-        self.stopped = False
-        self.lock = Lock()  # Thread synchronization
-        
+class WebcamVideoStream(BaseVideoStream):
+    def __init__(self, src=0, detect_faces=True, passthrough=False, detection_mode='track',
+                 motion_gating=True, vision_processes=0):
         # Face detection settings
         self.detect_faces = detect_faces
         self.face_cascade = None
-        self.face_detection_frame = None
-        self.face_detection_active = False
-        self.face_count = 0
-        self.last_detection_time = 0
-        self.detection_interval = 0.1  # Run detection every 100ms
+        self.detection_interval = 0.1  # Run the cascade at most every 100ms
+        self.detector = None
+
+        # Every detector reads the same per-frame grayscale pyramid and can be
+        # switched on its own; results are keyed by detector name
+        self.pipeline = DetectorPipeline()
+
+        # 'full' runs the cascade at full resolution every detection_interval.
+        # 'track' runs it on pyramid level 1 (half size) and follows the faces
+        # with optical flow on every frame in between, re-detecting only when
+        # a track is lost or once a second to pick up new faces.
+        self.detection_mode = detection_mode
+        self.detection_level = 1
+        self.tracker = None
+
+        # With vision_processes > 0 the downscaled cascade runs in that many
+        # worker processes instead of a thread (no tracking, which needs every
+        # frame in one place). Frames reach them through shared memory.
+        self.vision_processes = vision_processes
+        self.cascade_path = None
+
+        # A cheap frame-difference check runs first, and detection is skipped
+        # while the scene is static (e.g. the robot is parked)
+        self.motion_gate = MotionGate() if motion_gating else None
         
         if self.detect_faces:
             # Initialize face detection (load once, not in the loop)
             self._initialize_face_detection()
         
-        # Start the thread to read frames
-        self.processing_thread = Thread(target=self.update, daemon=True)
-        self.processing_thread.start()
+        # Opens the camera and starts the thread to read frames
+        super().__init__(src, passthrough=passthrough)
+
+        # Detection boxes are in these pixels; sent along for client-side drawing
+        self.frame_width = int(self.stream.get(cv2.CAP_PROP_FRAME_WIDTH)) or None
+        self.frame_height = int(self.stream.get(cv2.CAP_PROP_FRAME_HEIGHT)) or None
+
+        # Detection runs on its own thread, always on the newest frame, so
+        # the cascade's cost never holds up capture or streaming
+        if self.detect_faces and self.vision_processes > 0:
+            # The pool runs the face cascade itself; the pipeline entry only
+            # carries its enable flag, and any other detectors run alongside
+            self.pipeline.register('faces', PooledDetector('faces'), enabled=False)
+            detector = CascadeDetector(self.cascade_path, level=self.detection_level)
+            # Same per-process duty cycle as the single detection thread
+            self.detector = ProcessDetectionWorker(
+                self.bus, detector, self.vision_processes,
+                self.detection_interval / self.vision_processes, gate=self.motion_gate,
+                name='faces', level=self.detection_level, pipeline=self.pipeline)
+        elif self.detect_faces:
+            interval = self.detection_interval
+            level = 0  # 'full' runs the cascade on products.gray
+            if self.detection_mode == 'track':
+                # Scale minSize with the image so the smallest face stays the same
+                min_size = int(30 * 0.5 ** self.detection_level)
+                self.tracker = FaceTracker(lambda gray: self._cascade(gray, min_size),
+                                           level=self.detection_level,
+                                           detect_interval=self.detection_interval)
+                self.pipeline.register('faces', self.tracker.update, enabled=False)
+                interval = 0.0  # Tracking is cheap, so it runs on every frame it can get
+                level = self.detection_level
+            else:
+                self.pipeline.register('faces', self._detect_faces, enabled=False)
+            self.detector = DetectionWorker(self.bus, self.pipeline, interval, gate=self.motion_gate,
+                                            level=level)
+        if self.detector is not None:
+            self.detector.enabled = self.pipeline.active
+            # One shared broadcast of changes for every dashboard
+            self.events = DetectionEvents(self.detector.results, self._describe)
+        else:
+            self.events = None
     
     def _initialize_face_detection(self):
         # Load the face detection cascade classifier
         try:
             # First try to load the more accurate but slower model
-            self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+            self.cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
+            self.face_cascade = cv2.CascadeClassifier(self.cascade_path)
             if self.face_cascade.empty():
                 # If that fails, try the faster but less accurate model
-                self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_alt2.xml')
+                self.cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_alt2.xml'
+                self.face_cascade = cv2.CascadeClassifier(self.cascade_path)
                 if self.face_cascade.empty():
                     print("Warning: Could not load face cascade classifier")
                     self.detect_faces = False
@@ -63,87 +114,108 @@ class WebcamVideoStream:
             print(f"Error initializing face detection: {e}")
             self.detect_faces = False
     
+    def set_detector_enabled(self, name, enabled):
+        """Enable or disable one detector; returns its state, or None if unknown"""
+        with self.lock:
+            state = self.pipeline.set_enabled(name, enabled)
+            if self.detector is not None:
+                # The worker idles when nothing is enabled
+                self.detector.enabled = self.pipeline.active
+        return state
+
+    def get_detectors(self):
+        """Return {name: enabled} for every registered detector"""
+        return dict(self.pipeline.enabled)
+
+    @property
+    def face_detection_active(self):
+        return self.pipeline.enabled.get('faces', False)
+
     def toggle_face_detection(self, active):
         """Enable or disable face detection"""
-        with self.lock:
-            self.face_detection_active = active
-        return self.face_detection_active
-        
-    def update(self):
-        last_frame_time = time.time()
-        while not self.stopped:
-            # Skip frames if we're running behind (helps reduce latency)
-            current_time = time.time()
-            if current_time - last_frame_time < 0.01:  # Max ~100fps internal processing
-                continue
-                
-            # Get the latest frame and clear the buffer
-            for _ in range(2):  # Try to clear any buffered frames
-                if self.stream.isOpened():
-                    grabbed, frame = self.stream.read()
-                    if grabbed:
-                        with self.lock:
-                            self.grabbed, self.frame = grabbed, frame
-                            
-                            # Check if face detection is enabled and it's time to run detection
-                            if (self.detect_faces and self.face_detection_active and 
-                                current_time - self.last_detection_time >= self.detection_interval):
-                                self._detect_faces(frame)
-                                self.last_detection_time = current_time
-            
-            last_frame_time = current_time
+        return bool(self.set_detector_enabled('faces', active))
     
-    def _detect_faces(self, frame):
-        """Detect faces in the frame"""
+    def _detect_faces(self, products):
+        """Detect faces in the frame; runs on the detection thread"""
+        # Uses the frame's shared grayscale conversion
+        return self._cascade(products.gray)
+
+    def _cascade(self, gray, min_size=30):
+        """Run the face cascade on a grayscale image, full size or downscaled"""
         if self.face_cascade is None:
-            return
+            return []
             
         try:
-            # Convert to grayscale for face detection
-            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            
             # Optimize detection by using a smaller scale factor
             faces = self.face_cascade.detectMultiScale(
                 gray,
                 scaleFactor=1.2,
                 minNeighbors=5,
-                minSize=(30, 30),
+                minSize=(min_size, min_size),
                 flags=cv2.CASCADE_SCALE_IMAGE
             )
-            
-            # Create a copy of the frame to draw on
-            detection_frame = frame.copy()
-            
-            # Draw rectangles around faces
-            self.face_count = len(faces)
-            for (x, y, w, h) in faces:
-                cv2.rectangle(detection_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-                
-            # Update the face detection frame
-            self.face_detection_frame = detection_frame
+            return [tuple(int(v) for v in face) for face in faces]
         except Exception as e:
             print(f"Error in face detection: {e}")
+            return []
+
+    def _faces(self):
+        # Boxes from the latest detection while detection is on, else None
+        if not self.face_detection_active or self.detector is None:
+            return None
+        result = self.detector.latest()
+        return result.objects.get('faces') if result is not None else None
+
+    def get_overlay(self):
+        """Boxes for the encoder to draw on the live frame, or None"""
+        return self._faces()
+
+    def _describe(self, result):
+        # JSON form of a DetectionResult, for /detections and the event stream
+        if result is None:
+            return {'seq': 0, 'timestamp': 0.0, 'objects': {}, 'counts': {},
+                    'width': self.frame_width, 'height': self.frame_height}
+        return {'seq': result.seq, 'timestamp': result.timestamp, 'objects': result.objects,
+                'counts': {name: len(objects) for name, objects in result.objects.items()},
+                'width': self.frame_width, 'height': self.frame_height}
+
+    def get_detections(self):
+        """Latest detection as metadata, for browsers that draw it themselves"""
+        return self._describe(self.detector.latest() if self.detector is not None else None)
             
     def read(self):
         """Return the current frame with or without face detection"""
         with self.lock:
-            if self.face_detection_active and self.face_detection_frame is not None:
-                return self.face_detection_frame.copy()
-            elif self.grabbed:
-                return self.frame.copy()
-            else:
+            if not self.grabbed:
                 return None
+            frame = self.frame
+            frame.pin()
+        with frame:
+            image = as_image(frame).copy()
+        faces = self._faces()
+        if faces:
+            draw_boxes(image, faces)
+        return image
                 
     def get_face_count(self):
         """Return the number of faces detected in the last frame"""
-        return self.face_count
-            
+        faces = self._faces()
+        return len(faces) if faces else 0
+
+    def get_frame_size(self):
+        """(width, height) that detection boxes refer to"""
+        return (self.frame_width or 640, self.frame_height or 480)
+
+    def get_vision_stats(self):
+        """Detection worker counters, including the current motion energy"""
+        return self.detector.stats() if self.detector is not None else {}
+
     def stop(self):
-        print("Stopping camera stream...")
-        self.stopped = True
-        if self.processing_thread.is_alive():
-            self.processing_thread.join(timeout=1.0)
-        self.stream.release()
+        if self.detector is not None:
+            self.detector.stop()
+        if self.events is not None:
+            self.events.stop()
+        super().stop()
 
 app = Flask(__name__)
 
@@ -155,19 +227,85 @@ basic_auth = BasicAuth(app)
 
 # Global camera instance
 camera = None
+camera_lock = Lock()
+
+# Detection processes to run, e.g. 3 on a Pi 4; 0 keeps it on a thread
+VISION_PROCESSES = int(os.environ.get('HEXAPOD_VISION_PROCESSES', '0'))
+
+# 'burn' draws detection boxes into the video once, at encode time; 'client'
+# leaves the video untouched and the page draws /detections on a canvas
+OVERLAY_MODE = os.environ.get('HEXAPOD_OVERLAY', 'burn')
 
 def get_camera():
     global camera
-    if camera is None or camera.stopped:
-        camera = WebcamVideoStream(detect_faces=True)
-        camera.toggle_face_detection(True)  # Enable face detection by default
-        time.sleep(0.5)  # Short delay to ensure camera is initialized
+    with camera_lock:
+        if camera is None or camera.stopped:
+            camera = WebcamVideoStream(camera_source(), detect_faces=True, passthrough=True,
+                                       vision_processes=VISION_PROCESSES)
+            camera.toggle_face_detection(True)  # Enable face detection by default
+            time.sleep(0.5)  # Short delay to ensure camera is initialized
     return camera
 
-@app.route('/')
-@basic_auth.required
-def index():
-    return '''
+# Serial link for follow mode. Only opened when HEXAPOD_SERIAL_PORT is set,
+# so by default this app leaves the port to final.py. It is opened on first
+# use rather than at import: vision worker processes re-import this module,
+# and each open of the port can reset the Arduino.
+SERIAL_PORT = os.environ.get('HEXAPOD_SERIAL_PORT')
+ser = None
+serial_worker = None
+motion_scheduler = None
+serial_tried = False
+serial_lock = Lock()
+
+def get_serial():
+    """Motion scheduler on the follow-mode serial link, or None without one"""
+    global ser, serial_worker, motion_scheduler, serial_tried
+    with serial_lock:
+        if SERIAL_PORT and not serial_tried:
+            serial_tried = True  # One attempt, not one per /follow poll
+            try:
+                import serial
+                ser = serial.Serial(SERIAL_PORT, 115200, timeout=1)
+                time.sleep(2)
+                serial_worker = SerialWorker(ser)
+                motion_scheduler = MotionScheduler(serial_worker)
+                print("Serial connection established.")
+            except (ImportError, OSError) as e:
+                print(f"Error: Could not open serial port. {e}")
+    return motion_scheduler
+
+# Face-follow control loop, created on first use
+follower = None
+follower_lock = Lock()
+
+def get_follower():
+    global follower
+    cam = get_camera()
+    with follower_lock:
+        if follower is None and cam.detector is not None:
+            scheduler = get_serial()
+            if scheduler is not None:
+                follower = FaceFollower(cam.detector.results, scheduler.send,
+                                        cam.get_frame_size)
+    return follower
+
+def set_follow(enabled):
+    """Switch follow mode; returns (payload, status) like run_command"""
+    follower = get_follower()
+    if follower is None:
+        return {'response': 'Follow mode needs face detection and HEXAPOD_SERIAL_PORT'}, 500
+    if enabled:
+        get_camera().toggle_face_detection(True)
+    follower.set_enabled(enabled)
+    return follower.status(), 200
+
+# Shared encoder feeding every /video_feed viewer
+def get_encoder():
+    return get_shared_encoder(get_camera,
+                              lambda cam: cam.get_overlay if OVERLAY_MODE == 'burn' else None)
+
+# Dashboard page, served by both the Flask and the asyncio server
+INDEX_HTML = '''
     <!DOCTYPE html>
     <html>
     <head>
@@ -247,6 +385,7 @@ def index():
         </style>
         <script>
             let faceDetectionEnabled = true;
+            let clientOverlay = false;
             
             function toggleFaceDetection() {
                 fetch('/toggle_face_detection', {
@@ -261,6 +400,9 @@ def index():
                 .then(response => response.json())
                 .then(data => {
                     faceDetectionEnabled = data.enabled;
+                    if (!faceDetectionEnabled) {
+                        document.getElementById('faceCount').textContent = 0;
+                    }
                     updateUI();
                 })
                 .catch(error => {
@@ -294,10 +436,82 @@ def index():
                 });
             }
             
-            // Update face count every second
+            let following = false;
+            
+            function showFollow(data) {
+                following = data.enabled;
+                document.getElementById('followBtn').textContent = following ? 'Stop Following' : 'Follow Me';
+                document.getElementById('followBtn').className = following ? 'btn btn-off' : 'btn';
+                let text = data.response || ('Command: ' + (data.command || '-'));
+                if (data.latency_p50 !== undefined) {
+                    text += ' | see-to-act ' + Math.round(data.latency_p50 * 1000) + ' ms (p95 ' +
+                            Math.round(data.latency_p95 * 1000) + ' ms)';
+                }
+                document.getElementById('followStatus').textContent = text;
+            }
+            
+            function toggleFollow() {
+                fetch('/follow', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        'enabled': !following
+                    })
+                })
+                .then(response => response.json())
+                .then(showFollow)
+                .catch(error => {
+                    console.error('Error:', error);
+                });
+            }
+            
+            function drawDetections(data) {
+                const img = document.getElementById('stream');
+                const canvas = document.getElementById('overlay');
+                canvas.style.left = img.offsetLeft + 'px';
+                canvas.style.top = img.offsetTop + 'px';
+                const ctx = canvas.getContext('2d');
+                ctx.clearRect(0, 0, canvas.width, canvas.height);
+                const sx = canvas.width / (data.width || canvas.width);
+                const sy = canvas.height / (data.height || canvas.height);
+                ctx.strokeStyle = '#00ff00';
+                ctx.lineWidth = 2;
+                (data.objects.faces || []).forEach(([x, y, w, h]) => {
+                    ctx.strokeRect(x * sx, y * sy, w * sx, h * sy);
+                });
+            }
+            
+            function showDetections(data) {
+                document.getElementById('faceCount').textContent = data.counts.faces || 0;
+                // Draw boxes here only if the server leaves them out of the video
+                if (clientOverlay) {
+                    drawDetections(data);
+                }
+            }
+            
             window.onload = function() {
                 updateUI();
-                setInterval(updateFaceCount, 1000);
+                fetch('/detections')
+                .then(response => response.json())
+                .then(data => {
+                    clientOverlay = data.overlay === 'client';
+                    showDetections(data);
+                    setInterval(() => {
+                        if (following) {
+                            fetch('/follow').then(response => response.json()).then(showFollow);
+                        }
+                    }, 1000);
+                    if (window.EventSource) {
+                        // The server pushes an event only when detections change
+                        const events = new EventSource('/detection_events');
+                        events.onmessage = event => showDetections(JSON.parse(event.data));
+                    } else {
+                        // Update face count every second
+                        setInterval(updateFaceCount, 1000);
+                    }
+                });
             };
         </script>
     </head>
@@ -306,7 +520,9 @@ def index():
             <h1>Face Detection Camera Stream</h1>
             
             <div class="video-container">
-                <img src="/video_feed" width="640" height="480">
+                <img id="stream" src="/video_feed" width="640" height="480">
+                <canvas id="overlay" width="640" height="480"
+                        style="position: absolute; pointer-events: none;"></canvas>
             </div>
             
             <div class="controls">
@@ -323,6 +539,11 @@ def index():
                 Faces Detected: <span id="faceCount" class="face-count">0</span>
             </div>
             
+            <div class="controls">
+                <button id="followBtn" class="btn" onclick="toggleFollow()">Follow Me</button>
+                <div id="followStatus"></div>
+            </div>
+            
             <p>
                 <small>Optimized for low-latency streaming with real-time face detection</small>
             </p>
@@ -331,30 +552,16 @@ def index():
     </html>
     '''
 
-def gen():
-    cam = get_camera()
-    jpeg_quality = 70  # Lower quality = faster encoding (adjust as needed)
-    encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
-    
-    while True:
-        frame = cam.read()
-        if frame is None:
-            time.sleep(0.01)  # Short sleep if frame not available
-            continue
-            
-        # Encode with optimized parameters
-        ret, jpeg = cv2.imencode('.jpg', frame, encode_params)
-        if not ret:
-            continue
-            
-        # Send frame immediately
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+@app.route('/')
+@basic_auth.required
+def index():
+    return INDEX_HTML
 
 @app.route('/video_feed')
 @basic_auth.required
 def video_feed():
-    return Response(gen(), 
+    adaptive = not is_local_client(request.remote_addr, request.headers.get('X-Forwarded-For'))
+    return Response(mjpeg_stream(get_encoder(), adaptive),
                    mimetype='multipart/x-mixed-replace; boundary=frame')
 
 @app.route('/toggle_face_detection', methods=['POST'])
@@ -375,6 +582,64 @@ def face_count():
     count = cam.get_face_count()
     return jsonify({'count': count})
 
+# Per-detector enable flags: GET lists them, POST {"name", "enabled"} sets one
+@app.route('/detectors', methods=['GET', 'POST'])
+@basic_auth.required
+def detectors():
+    cam = get_camera()
+    if request.method == 'POST':
+        data = request.json
+        if cam.set_detector_enabled(data.get('name'), data.get('enabled', False)) is None:
+            return jsonify({'response': 'Unknown detector'}), 404
+    return jsonify(cam.get_detectors())
+
+# Latest detection results as metadata (the side channel for 'client' overlay)
+@app.route('/detections')
+@basic_auth.required
+def detections():
+    return jsonify(dict(get_camera().get_detections(), overlay=OVERLAY_MODE))
+
+# Server-Sent Events stream of detection changes, shared by every dashboard
+@app.route('/detection_events')
+@basic_auth.required
+def detection_events():
+    cam = get_camera()
+    if cam.events is None:
+        return jsonify({'response': 'Detection not available'}), 404
+    return Response(cam.events.stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+# Follow mode: GET returns the loop's state and see-to-act latency, POST
+# {"enabled": true/false} switches it
+@app.route('/follow', methods=['GET', 'POST'])
+@basic_auth.required
+def follow():
+    if request.method == 'POST':
+        payload, status = set_follow(request.json.get('enabled', False))
+        return jsonify(payload), status
+    follower = get_follower()
+    if follower is None:
+        return jsonify({'enabled': False, 'available': False})
+    return jsonify(follower.status())
+
+@app.route('/vision_stats')
+@basic_auth.required
+def vision_stats():
+    return jsonify(get_camera().get_vision_stats())
+
+def cleanup():
+    if follower is not None:
+        follower.stop()
+    if motion_scheduler is not None:
+        motion_scheduler.stop()
+    if serial_worker is not None:
+        serial_worker.stop()
+    stop_shared_encoder()
+    if camera is not None:
+        camera.stop()
+    if ser is not None:
+        ser.close()
+
 if __name__ == '__main__':
     try:
         # Run with minimal overhead
@@ -382,5 +647,4 @@ if __name__ == '__main__':
                use_reloader=False)  # Disable reloader for production
     finally:
         # Cleanup
-        if camera is not None:
-            camera.stop()
\ No newline at end of file
+        cleanup()
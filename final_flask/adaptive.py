@@ -0,0 +1,103 @@
+import time
+import ipaddress
+
+# Quality ladder from full quality down to the cheapest useful stream:
+# (JPEG quality, resolution scale, max frames per second)
+LEVELS = [
+    (70, 1.0, 30),
+    (60, 1.0, 20),
+    (50, 0.75, 15),
+    (40, 0.5, 10),
+    (30, 0.5, 5),
+]
+
+
+def is_local_client(remote_addr, forwarded_for=None):
+    """True for clients on the LAN; tunnelled (ngrok) requests carry X-Forwarded-For"""
+    if forwarded_for:
+        return False
+    try:
+        addr = ipaddress.ip_address(remote_addr)
+    except (TypeError, ValueError):
+        return False
+    return addr.is_private or addr.is_loopback
+
+
+# Per-client controller for one MJPEG stream. It watches how long the server
+# blocks writing each frame (socket backpressure) and how old frames are when
+# they leave, and walks the LEVELS ladder to hold a target latency.
+class AdaptiveStreamController:
+    def __init__(self, target_latency=0.25, levels=LEVELS):
+        self.target_latency = target_latency
+        self.levels = levels
+        self.level = 0
+        self.send_time = 0.0  # Smoothed seconds spent writing one frame
+        self.latency = 0.0    # Smoothed capture-to-sent latency
+        self.last_sent = 0.0
+        self.frames_sent = 0
+        self._good_frames = 0
+        self._hold = 0        # Frames to wait after a change before judging again
+
+    @property
+    def quality(self):
+        return self.levels[self.level][0]
+
+    @property
+    def scale(self):
+        return self.levels[self.level][1]
+
+    @property
+    def fps(self):
+        return self.levels[self.level][2]
+
+    def pace_delay(self):
+        """Seconds until the current frame-rate cap allows another frame"""
+        return max(0.0, self.last_sent + 1.0 / self.fps - time.time())
+
+    def pace(self):
+        """Sleep until the current frame-rate cap allows another frame"""
+        delay = self.pace_delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def observe(self, send_seconds, capture_time):
+        """Record one delivered frame and adjust the stream level"""
+        now = time.time()
+        self.last_sent = now
+        self.frames_sent += 1
+        alpha = 0.2
+        self.send_time += alpha * (send_seconds - self.send_time)
+        self.latency += alpha * ((now - capture_time) - self.latency)
+
+        if self._hold > 0:
+            self._hold -= 1
+            return
+
+        frame_budget = 1.0 / self.fps
+        if self.latency > self.target_latency or self.send_time > frame_budget:
+            self._good_frames = 0
+            if self.level < len(self.levels) - 1:
+                self._set_level(self.level + 1)
+        elif self.latency < self.target_latency / 2 and self.send_time < frame_budget / 2:
+            # Step back up only after a sustained run of healthy frames
+            self._good_frames += 1
+            if self._good_frames >= 2 * self.fps and self.level > 0:
+                self._set_level(self.level - 1)
+        else:
+            self._good_frames = 0
+
+    def _set_level(self, level):
+        self.level = level
+        self._good_frames = 0
+        self._hold = 5
+
+    def stats(self):
+        return {
+            'level': self.level,
+            'quality': self.quality,
+            'scale': self.scale,
+            'fps': self.fps,
+            'send_time': self.send_time,
+            'latency': self.latency,
+            'frames_sent': self.frames_sent,
+        }
@@ -0,0 +1,262 @@
+import os
+import sys
+import tty
+import time
+import select
+import argparse
+from threading import Thread
+import protocol
+from firmware_model import (GAIT_STEPS, INITIAL_ANGLES, DEFAULT_SPEED, DIRECTION_NAMES,
+                            tripod_b_lifted)
+
+FRAME_TIMEOUT = 0.05  # Same as FRAME_TIMEOUT_MS in the firmware
+
+
+# Stands in for Hexapod_final.ino on a pseudo-terminal, so the serial path in
+# final.py can be exercised and benchmarked without the robot. It follows the
+# firmware's loop(): poll the link, then run one gait cycle for the current
+# direction, waiting `speed` ms between steps while still serving commands.
+class ArduinoEmulator:
+    def __init__(self, speed=DEFAULT_SPEED, baud=115200, echo=True, link=None):
+        self.speed = speed
+        self.baud = baud      # Used to charge wire time for every byte, both ways
+        self.echo = echo      # Also write the firmware's debug prints to the port
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self.link = link
+        if link:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.port, link)
+
+        self.direction = 'a'
+        self.angles = list(INITIAL_ANGLES)
+        self.streaming = False  # Host is sending whole poses; gaits stand aside
+        self.direction_changed = False  # A command switched direction mid-cycle
+        self.framed_link = False  # A valid frame has arrived; bare letters are ignored
+        self.stopped = False
+
+        # Parser state, as in pollSerial()
+        self._in_frame = False
+        self._frame = bytearray()
+        self._frame_start = 0.0
+
+        self.frames_received = 0
+        self.crc_errors = 0
+        self.legacy_commands = 0
+        self.poses_received = 0
+        self.cycles = 0
+
+    def run(self):
+        self._log("Bluetooth communication setup complete.")
+        while not self.stopped:
+            # With no gait to run, loop() just spins on pollSerial()
+            self._poll(0 if self.direction in GAIT_STEPS else 0.05)
+            self.direction_changed = False
+            if self.direction in GAIT_STEPS:
+                self._run_cycle(self.direction)
+
+    def start(self):
+        """Run the emulator on a daemon thread and return it"""
+        Thread(target=self.run, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def _run_cycle(self, direction):
+        for i, step in enumerate(GAIT_STEPS[direction]):
+            for servo, angle in step.writes:
+                self.angles[servo] = angle
+            if step.delay and not self._step_delay(self.speed):
+                return  # A pose frame or a new direction took over mid-cycle
+            if direction == 'F':
+                self._log(f"step{min(i + 1, 6)}")  # The firmware prints step6 twice
+        self.cycles += 1
+        self._log(DIRECTION_NAMES[direction])
+
+    def _step_delay(self, ms):
+        deadline = time.monotonic() + ms / 1000.0
+        while not self.stopped:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._poll(remaining)
+            if self.streaming:
+                return False
+            if self.direction_changed:
+                if self.direction == 'S' or tripod_b_lifted(self.angles):
+                    self._settle()
+                return False
+        return True
+
+    def _settle(self):
+        # settle(): every leg down in the standing pose, then one step's wait
+        self.angles = list(INITIAL_ANGLES)
+        deadline = time.monotonic() + self.speed / 1000.0
+        while not self.stopped and time.monotonic() < deadline:
+            self._poll(max(0.0, deadline - time.monotonic()))
+
+    def _poll(self, timeout):
+        readable, _, _ = select.select([self.master_fd], [], [], timeout)
+        if readable:
+            data = os.read(self.master_fd, 1024)
+            if self.baud:
+                time.sleep(len(data) * 10.0 / self.baud)  # Wire time of the bytes received
+            for b in data:
+                self._feed(b)
+        if self._in_frame and time.monotonic() - self._frame_start > FRAME_TIMEOUT:
+            self._in_frame = False
+
+    def _feed(self, b):
+        if not self._in_frame:
+            if b == protocol.SOF:
+                self._in_frame = True
+                self._frame.clear()
+                self._frame_start = time.monotonic()
+            elif not self.framed_link and chr(b) in 'FBLRS':
+                self.legacy_commands += 1
+                self._set_direction(chr(b))
+            return
+
+        # _frame holds LEN, SEQ, TYPE, PAYLOAD..., CRC
+        self._frame.append(b)
+        if self._frame[0] > protocol.MAX_PAYLOAD:
+            self._in_frame = False
+            return
+        if len(self._frame) == self._frame[0] + 4:
+            self._in_frame = False
+            body = bytes(self._frame[:-1])
+            if protocol.crc8(body) != self._frame[-1]:
+                self.crc_errors += 1
+                self._send(protocol.encode_frame(body[1], protocol.TYPE_NACK))
+                return
+            self.frames_received += 1
+            self.framed_link = True
+            self._handle_frame(body[1], body[2], body[3:])
+
+    def _handle_frame(self, seq, frame_type, payload):
+        if frame_type == protocol.TYPE_DIRECTION:
+            ok = len(payload) == 1 and self._set_direction(chr(payload[0]))
+            status = protocol.ACK_OK if ok else protocol.ACK_BAD_PAYLOAD
+        elif frame_type in (protocol.TYPE_POSE, protocol.TYPE_JOINTS):
+            joints = protocol.decode_joints(frame_type, payload)
+            if joints is not None:
+                self._apply(joints)
+            status = protocol.ACK_OK if joints is not None else protocol.ACK_BAD_PAYLOAD
+        else:
+            status = protocol.ACK_UNKNOWN_TYPE
+        self._send(protocol.encode_frame(seq, protocol.TYPE_ACK, bytes([status])))
+
+    def _apply(self, joints):
+        # Streamed servo angles take over from the built-in gait
+        self.streaming = True
+        self.direction = 'S'
+        for servo, angle in joints:
+            self.angles[servo] = angle
+        self.poses_received += 1
+
+    def _set_direction(self, command):
+        self._log(command)
+        self.streaming = False
+        if command != self.direction:
+            self.direction_changed = True
+        if command in DIRECTION_NAMES or command == 'S':
+            self.direction = command
+            if command in DIRECTION_NAMES:
+                self._log(DIRECTION_NAMES[command])
+            return True
+        self.direction = 'S'
+        self._log(f"Unknown command: {command}")
+        return False
+
+    def _send(self, data):
+        os.write(self.master_fd, data)
+        if self.baud:
+            time.sleep(len(data) * 10.0 / self.baud)  # 8N1: ten bits per byte
+
+    def _log(self, line):
+        if self.echo:
+            self._send(line.encode() + b'\r\n')
+
+
+def benchmark(port, count=200, framed=True):
+    """Send count direction commands one at a time and time the round trips"""
+    import serial
+    from serial_worker import SerialWorker
+
+    ser = serial.Serial(port, 115200, timeout=1)
+    worker = SerialWorker(ser, framed=framed)
+    latencies = []
+    started = time.time()
+    for i in range(count):
+        entry = worker.submit('FBLRS'[i % 5])
+        entry.future.result()  # Wait, or the worker would coalesce them
+        if entry.acked is not None:
+            latencies.append(entry.acked - entry.sent)
+    elapsed = time.time() - started
+    worker.stop()
+    ser.close()
+
+    latencies.sort()
+    result = {'commands': count, 'seconds': elapsed, 'commands_per_second': count / elapsed,
+              'acked': len(latencies), 'retransmits': worker.retransmits}
+    if latencies:
+        result['ack_latency_p50'] = latencies[len(latencies) // 2]
+        result['ack_latency_p95'] = latencies[int(len(latencies) * 0.95) - 1]
+        result['ack_latency_max'] = latencies[-1]
+    return result
+
+
+def benchmark_poses(port, count=500, delta=True, rate=150.0, direction='F'):
+    """Stream count gait poses back to back and report the rate the link sustains"""
+    import serial
+    from serial_worker import SerialWorker
+    from gait import keyframes, trajectory
+
+    poses = trajectory(keyframes(direction), DEFAULT_SPEED / 1000.0, rate)
+    ser = serial.Serial(port, 115200, timeout=1)
+    worker = SerialWorker(ser, delta_poses=delta)
+    for i in range(count):
+        worker.submit_pose(poses[i % len(poses)].tolist()).future.result()
+    worker.stop()
+    ser.close()
+    return worker.pose_stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Emulate Hexapod_final.ino on a pseudo-terminal")
+    parser.add_argument('--link', default='/tmp/hexapod-tty',
+                        help="symlink to the pty, for HEXAPOD_SERIAL_PORT")
+    parser.add_argument('--speed', type=int, default=DEFAULT_SPEED, help="ms between gait steps")
+    parser.add_argument('--no-echo', action='store_true', help="keep debug prints off the port")
+    parser.add_argument('--bench', type=int, metavar='N',
+                        help="run N commands through SerialWorker and report latency")
+    parser.add_argument('--legacy', action='store_true', help="benchmark bare command letters")
+    parser.add_argument('--bench-poses', type=int, metavar='N',
+                        help="stream N gait poses, as full frames and as deltas, and compare")
+    args = parser.parse_args()
+
+    emulator = ArduinoEmulator(speed=args.speed, echo=not args.no_echo, link=args.link).start()
+    print(f"Emulating Hexapod_final on {emulator.port} (linked at {args.link})")
+    try:
+        if args.bench_poses:
+            for delta in (False, True):
+                stats = benchmark_poses(emulator.port, args.bench_poses, delta)
+                print(f"{stats['mode']}: {stats['frames_per_second']:.1f} frames/s, "
+                      f"{stats['bytes_per_frame']:.1f} bytes/frame, {stats['keyframes']} keyframes")
+        elif args.bench:
+            for key, value in benchmark(emulator.port, args.bench, framed=not args.legacy).items():
+                print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+        else:
+            print(f"Start the app with HEXAPOD_SERIAL_PORT={args.link} python final.py")
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        sys.exit(0)
@@ -0,0 +1,366 @@
+import sys
+import json
+import time
+import hmac
+import base64
+import asyncio
+import importlib
+from threading import Thread
+from adaptive import AdaptiveStreamController, is_local_client
+
+
+# Asyncio mirror of a threaded FrameBus. One bridge thread per bus forwards
+# new items into the event loop, so any number of viewers can wait on it
+# without each holding an OS thread.
+class AsyncFrameBus:
+    def __init__(self, bus, loop):
+        self._cond = asyncio.Condition()
+        self._seq = 0
+        self._frame = None
+        self._timestamp = 0.0
+        self.closed = False
+        Thread(target=self._bridge, args=(bus, loop), daemon=True).start()
+
+    def _bridge(self, bus, loop):
+        seq = 0
+        while not bus.closed:
+            seq, frame, timestamp = bus.wait_stamped(seq, 1.0)
+            if frame is not None:
+                asyncio.run_coroutine_threadsafe(self._publish(seq, frame, timestamp), loop)
+        asyncio.run_coroutine_threadsafe(self._close(), loop)
+
+    async def _publish(self, seq, frame, timestamp):
+        async with self._cond:
+            self._seq, self._frame, self._timestamp = seq, frame, timestamp
+            self._cond.notify_all()
+
+    async def _close(self):
+        async with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    async def wait(self, last_seq=0, timeout=1.0):
+        """Await an item newer than last_seq; returns (seq, frame, timestamp)"""
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self._seq > last_seq or self.closed), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if self._seq > last_seq:
+                return self._seq, self._frame, self._timestamp
+            return last_seq, None, 0.0
+
+
+# ASGI front end for one of the Flask apps (final or OpencvF). It serves the
+# same routes from a single event loop; camera, encoding and serial work stay
+# in their existing threads and are awaited through the default executor.
+class HexapodASGI:
+    def __init__(self, module):
+        self.module = module
+        self.routes = {('GET', '/'): self.index}
+        self.prefix_routes = {}
+        if hasattr(module, 'get_encoder'):
+            self.routes[('GET', '/video_feed')] = self.video_feed
+        if hasattr(module, 'run_command'):
+            self.routes[('POST', '/send_command')] = self.send_command
+            self.routes[('POST', '/chat_command')] = self.chat_command
+        # Only where the Flask app has the route and the serial link is up
+        endpoints = module.app.view_functions
+        if getattr(module, 'serial_worker', None) is not None and 'command_status' in endpoints:
+            self.prefix_routes[('GET', '/command_status/')] = self.command_status
+        if getattr(module, 'motion_scheduler', None) is not None and 'motion_status' in endpoints:
+            self.prefix_routes[('GET', '/motion_status/')] = self.motion_status
+            self.prefix_routes[('POST', '/cancel_motion/')] = self.cancel_motion
+        if hasattr(module, 'set_gait'):
+            self.routes[('GET', '/gait')] = self.gait
+            self.routes[('POST', '/gait')] = self.gait
+        if hasattr(module, 'set_follow'):
+            self.routes[('GET', '/follow')] = self.follow
+            self.routes[('POST', '/follow')] = self.follow
+        if hasattr(module, 'toggle_face_detection'):
+            self.routes[('POST', '/toggle_face_detection')] = self.toggle_face_detection
+            self.routes[('GET', '/face_count')] = self.face_count
+            self.routes[('GET', '/vision_stats')] = self.vision_stats
+            self.routes[('GET', '/detections')] = self.detections
+            self.routes[('GET', '/detection_events')] = self.detection_events
+            self.routes[('GET', '/detectors')] = self.detectors
+            self.routes[('POST', '/detectors')] = self.detectors
+
+        # Match the Flask app's auth rules
+        self.protected_prefixes = set()
+        if module.app.config.get('BASIC_AUTH_FORCE'):
+            self.protected = {path for _, path in self.routes}
+            self.protected_prefixes = {prefix for _, prefix in self.prefix_routes}
+        elif getattr(module, 'auth_enabled', False):
+            self.protected = {'/video_feed'}
+        else:
+            self.protected = set()
+
+        self._encoder = None
+        self._encoder_bus = None
+        self._events = None
+        self._events_bus = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path']
+        handler = self.routes.get((scope['method'], path))
+        if handler is None:
+            for (method, prefix), prefix_handler in self.prefix_routes.items():
+                if method == scope['method'] and path.startswith(prefix):
+                    handler = prefix_handler
+        if handler is None:
+            allowed = any(route_path == path for _, route_path in self.routes)
+            await self._respond(send, 405 if allowed else 404, b'', 'text/plain')
+            return
+        protected = path in self.protected or any(path.startswith(prefix)
+                                                  for prefix in self.protected_prefixes)
+        if protected and not self._authorized(scope):
+            await send({'type': 'http.response.start', 'status': 401,
+                        'headers': [(b'content-type', b'text/plain'),
+                                    (b'www-authenticate', b'Basic realm="Login Required"')]})
+            await send({'type': 'http.response.body', 'body': b'Authentication required'})
+            return
+        await handler(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(None, self._cleanup)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _cleanup(self):
+        cleanup = getattr(self.module, 'cleanup', None)
+        if cleanup is not None:
+            cleanup()
+            return
+        for name in ('encoder', 'camera'):
+            obj = getattr(self.module, name, None)
+            if obj is not None:
+                obj.stop()
+
+    def _authorized(self, scope):
+        auth = dict(scope['headers']).get(b'authorization', b'')
+        if not auth.startswith(b'Basic '):
+            return False
+        try:
+            username, _, password = base64.b64decode(auth[6:]).decode().partition(':')
+        except ValueError:
+            return False
+        config = self.module.app.config
+        return (hmac.compare_digest(username, config['BASIC_AUTH_USERNAME'])
+                and hmac.compare_digest(password, config['BASIC_AUTH_PASSWORD']))
+
+    async def _respond(self, send, status, body, content_type):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type.encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _json(self, send, payload, status=200):
+        await self._respond(send, status, json.dumps(payload).encode(), 'application/json')
+
+    async def _read_json(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        try:
+            return json.loads(body or b'{}')
+        except ValueError:
+            return {}
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def index(self, scope, receive, send):
+        await self._respond(send, 200, self.module.INDEX_HTML.encode(), 'text/html; charset=utf-8')
+
+    async def send_command(self, scope, receive, send):
+        data = await self._read_json(receive)
+        # Only queues the command on the serial worker, so no executor hop
+        payload, status = self.module.run_command(data.get('command', ''))
+        await self._json(send, payload, status)
+
+    async def chat_command(self, scope, receive, send):
+        data = await self._read_json(receive)
+        # Timed motions are scheduled rather than slept on, so this is quick
+        payload, status = self.module.run_chat_command(data.get('message', ''))
+        await self._json(send, payload, status)
+
+    def _path_id(self, scope):
+        try:
+            return int(scope['path'].rsplit('/', 1)[1])
+        except ValueError:
+            return None
+
+    async def _lookup(self, send, owner, lookup, scope, missing):
+        # Shared body of the /<thing>/<id> status routes
+        if owner is None:
+            await self._json(send, {"response": "Serial not connected"}, 500)
+            return
+        item_id = self._path_id(scope)
+        status = lookup(item_id) if item_id is not None else None
+        if status is None:
+            await self._json(send, {"response": missing}, 404)
+            return
+        await self._json(send, status)
+
+    async def command_status(self, scope, receive, send):
+        worker = self.module.serial_worker
+        await self._lookup(send, worker, worker and worker.status, scope, "Unknown command id")
+
+    async def motion_status(self, scope, receive, send):
+        scheduler = self.module.motion_scheduler
+        await self._lookup(send, scheduler, scheduler and scheduler.status, scope, "Unknown motion id")
+
+    async def cancel_motion(self, scope, receive, send):
+        scheduler = self.module.motion_scheduler
+        await self._lookup(send, scheduler, scheduler and scheduler.cancel, scope, "Unknown motion id")
+
+    async def toggle_face_detection(self, scope, receive, send):
+        data = await self._read_json(receive)
+        cam = await self._run(self.module.get_camera)
+        await self._json(send, {'enabled': cam.toggle_face_detection(data.get('enabled', False))})
+
+    async def face_count(self, scope, receive, send):
+        cam = await self._run(self.module.get_camera)
+        await self._json(send, {'count': cam.get_face_count()})
+
+    async def detectors(self, scope, receive, send):
+        cam = await self._run(self.module.get_camera)
+        if scope['method'] == 'POST':
+            data = await self._read_json(receive)
+            if cam.set_detector_enabled(data.get('name'), data.get('enabled', False)) is None:
+                await self._json(send, {'response': 'Unknown detector'}, 404)
+                return
+        await self._json(send, cam.get_detectors())
+
+    async def gait(self, scope, receive, send):
+        if scope['method'] == 'POST':
+            data = await self._read_json(receive)
+            payload, status = await self._run(self.module.set_gait, data)
+            await self._json(send, payload, status)
+            return
+        engine = self.module.gait_engine
+        await self._json(send, dict(engine.status(), enabled=True) if engine is not None
+                         else {'enabled': False})
+
+    async def follow(self, scope, receive, send):
+        if scope['method'] == 'POST':
+            data = await self._read_json(receive)
+            payload, status = await self._run(self.module.set_follow, data.get('enabled', False))
+            await self._json(send, payload, status)
+            return
+        follower = await self._run(self.module.get_follower)
+        await self._json(send, follower.status() if follower is not None
+                         else {'enabled': False, 'available': False})
+
+    async def detections(self, scope, receive, send):
+        cam = await self._run(self.module.get_camera)
+        await self._json(send, dict(cam.get_detections(), overlay=self.module.OVERLAY_MODE))
+
+    async def vision_stats(self, scope, receive, send):
+        cam = await self._run(self.module.get_camera)
+        await self._json(send, cam.get_vision_stats())
+
+    async def _get_encoder_bus(self):
+        enc = await self._run(self.module.get_encoder)
+        if enc is not self._encoder:
+            self._encoder = enc
+            self._encoder_bus = AsyncFrameBus(enc.bus, asyncio.get_running_loop())
+        return enc, self._encoder_bus
+
+    async def detection_events(self, scope, receive, send):
+        cam = await self._run(self.module.get_camera)
+        if cam.events is None:
+            await self._json(send, {'response': 'Detection not available'}, 404)
+            return
+        if cam.events is not self._events:
+            self._events = cam.events
+            self._events_bus = AsyncFrameBus(cam.events.bus, asyncio.get_running_loop())
+        bus = self._events_bus
+
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'),
+                                (b'cache-control', b'no-cache')]})
+        try:
+            seq = 0
+            last_sent = time.time()
+            while not disconnected.done() and not bus.closed:
+                seq, event, _ = await bus.wait(seq)
+                if event is None:
+                    if time.time() - last_sent < cam.events.keepalive:
+                        continue
+                    event = b': keepalive\n\n'
+                await send({'type': 'http.response.body', 'body': event, 'more_body': True})
+                last_sent = time.time()
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+
+    async def video_feed(self, scope, receive, send):
+        enc, bus = await self._get_encoder_bus()
+        headers = dict(scope['headers'])
+        client = scope.get('client') or (None, None)
+        forwarded_for = headers.get(b'x-forwarded-for')
+        controller = None if is_local_client(client[0], forwarded_for) else AdaptiveStreamController()
+
+        # Servers keep calling send() silently after a disconnect, so watch
+        # for it explicitly
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'multipart/x-mixed-replace; boundary=frame')]})
+        try:
+            with enc.viewer():
+                seq = 0
+                while not disconnected.done() and not bus.closed:
+                    if controller is not None:
+                        await asyncio.sleep(controller.pace_delay())
+                    seq, part, timestamp = await bus.wait(seq)
+                    if part is None:
+                        continue
+                    if enc.wants_variant(controller):
+                        part = await self._run(enc.encode_variant, seq,
+                                               controller.quality, controller.scale)
+                        if part is None:
+                            continue
+
+                    # send() waits for the transport to drain, which is the
+                    # backpressure the controller reacts to
+                    started = time.time()
+                    await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+                    if controller is not None:
+                        controller.observe(time.time() - started, timestamp)
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+
+    async def _wait_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+
+if __name__ == '__main__':
+    # Usage: python asgi.py [final|OpencvF|liveS]
+    try:
+        import uvicorn
+    except ImportError:
+        print("uvicorn not installed, run: pip install uvicorn")
+        sys.exit(1)
+    module = importlib.import_module(sys.argv[1] if len(sys.argv) > 1 else 'final')
+    uvicorn.run(HexapodASGI(module), host='0.0.0.0', port=5000, log_level='warning')
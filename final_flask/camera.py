@@ -0,0 +1,202 @@
+import os
+import cv2
+import time
+import numpy as np
+from threading import Thread, Lock
+from framebus import FrameBus, FrameRing
+
+
+# A compressed frame straight from the camera, decoded only when a consumer
+# actually needs pixels
+class JpegFrame:
+    def __init__(self, jpeg):
+        self.jpeg = jpeg
+        self.timestamp = 0.0
+        self._image = None
+        self._lock = Lock()
+
+    @property
+    def image(self):
+        """Decoded BGR pixels, computed once on first access"""
+        with self._lock:
+            if self._image is None:
+                self._image = cv2.imdecode(np.frombuffer(self.jpeg, np.uint8), cv2.IMREAD_COLOR)
+            return self._image
+
+    # JPEG bytes are immutable, so there is nothing to pin
+    def pin(self):
+        pass
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def camera_source():
+    """Capture source chosen by HEXAPOD_CAMERA.
+
+    Unset or a number opens that camera directly; 'shared' attaches to the
+    frames published by camera_service.py instead, so several apps can run
+    off one camera. 'synthetic' or a video file path replays repeatable
+    input instead of a camera, at the source's own rate, or as fast as it
+    can be read with HEXAPOD_REPLAY=max.
+    """
+    source = os.environ.get('HEXAPOD_CAMERA', '0')
+    if source == 'shared':
+        from shm_bus import SharedFrameCapture
+        return SharedFrameCapture()
+    if source == 'synthetic' or os.path.isfile(source):
+        from sources import open_source
+        return open_source(source, 0 if os.environ.get('HEXAPOD_REPLAY') == 'max' else None)
+    return int(source) if source.isdigit() else source
+
+
+def as_image(frame):
+    """Return BGR pixels for a ring slot, a JpegFrame or a plain array"""
+    return getattr(frame, 'image', frame)
+
+
+def _is_jpeg(buf):
+    # Raw MJPEG buffers come back as a flat uint8 array starting with SOI
+    return (buf is not None and buf.dtype == np.uint8 and buf.size > 2
+            and (buf.ndim == 1 or buf.shape[0] == 1)
+            and buf.flat[0] == 0xFF and buf.flat[1] == 0xD8)
+
+
+# Optimized Webcam class with minimal buffering and latency
+class WebcamVideoStream:
+    def __init__(self, src=0, passthrough=False, ring_slots=6):
+        print("Initializing camera...")
+        # src may also be an object with cv2.VideoCapture's interface, such as
+        # a SharedFrameCapture reading from camera_service.py
+        self.stream = src if hasattr(src, 'read') else cv2.VideoCapture(src)
+
+        # Aggressive camera optimization settings
+        self.stream.set(cv2.CAP_PROP_BUFFERSIZE, 1)      # Minimum buffer size
+        self.stream.set(cv2.CAP_PROP_FRAME_WIDTH, 640)   # Reasonable resolution
+        self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        self.stream.set(cv2.CAP_PROP_FPS, 30)            # Target FPS
+
+        # Try to disable auto focus which can cause periodic delays
+        self.stream.set(cv2.CAP_PROP_AUTOFOCUS, 0)
+
+        # For some cameras, lower quality can reduce latency
+        self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+
+        # Pass-through mode hands the camera's own JPEG bytes to the encoder
+        # instead of decoding to BGR and re-encoding every frame
+        self.passthrough = passthrough and self._enable_passthrough()
+
+        # Decoded frames are captured in place into a fixed ring of buffers,
+        # sized from the first frame the camera delivers
+        self.ring = None
+        self.ring_slots = ring_slots
+
+        self.grabbed, self.frame = self._read()
+        self.stopped = False
+        self.lock = Lock()  # Thread synchronization
+        # Sequenced hand-off to gen() and other consumers; every frame handed
+        # out is pinned and must be released by the consumer
+        self.bus = FrameBus(pin=lambda frame: frame.pin())
+
+        # Start the thread to read frames
+        self.processing_thread = Thread(target=self.update, daemon=True)
+        self.processing_thread.start()
+
+    def _enable_passthrough(self):
+        if not self.stream.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+            print("Camera does not support MJPEG pass-through, decoding frames")
+            return False
+        grabbed, buf = self.stream.read()
+        if grabbed and _is_jpeg(buf):
+            print("MJPEG pass-through enabled")
+            return True
+        print("Camera did not deliver JPEG data, decoding frames")
+        self.stream.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        return False
+
+    def _read(self):
+        if self.passthrough:
+            grabbed, frame = self.stream.read()
+            if not grabbed or not _is_jpeg(frame):
+                return False, None
+            return True, JpegFrame(frame.tobytes())
+
+        if self.ring is None:
+            grabbed, frame = self.stream.read()
+            if not grabbed:
+                return False, None
+            self.ring = FrameRing(frame.shape, self.ring_slots)
+            slot = self.ring.claim()
+            np.copyto(slot.buffer, frame)
+            return True, slot
+
+        slot = self.ring.claim()
+        if slot is None:
+            # Readers still hold every slot; drop this frame rather than allocate
+            self.stream.grab()
+            return False, None
+        grabbed, frame = self.stream.read(slot.buffer)
+        if grabbed and frame is not slot.buffer:
+            # The camera changed resolution, so the ring has to be rebuilt
+            slot.release()
+            self.ring = None
+            return False, None
+        if not grabbed:
+            slot.release()
+            return False, None
+        return True, slot
+
+    def update(self):
+        # stream.read() blocks until the camera delivers the next frame, so the
+        # loop is paced by the camera itself instead of spinning on a timer
+        while not self.stopped:
+            if not self.stream.isOpened():
+                time.sleep(0.1)
+                continue
+            grabbed, frame = self._read()
+            if not grabbed:
+                time.sleep(0.01)
+                continue
+            current_time = time.time()
+            frame.timestamp = current_time
+            with self.lock:
+                previous = self.frame
+                self.grabbed, self.frame = grabbed, frame
+            self.bus.publish(frame, current_time)
+            # Drop the capture's own pin; readers still holding it keep it alive
+            if previous is not None:
+                previous.release()
+
+    def read(self):
+        """Return a private copy of the latest frame"""
+        with self.lock:
+            frame = self.frame if self.grabbed else None
+            if frame is None:
+                return None
+            frame.pin()
+        with frame:
+            return as_image(frame).copy()
+
+    def wait_frame(self, last_seq=0, timeout=1.0):
+        """Block until a frame newer than last_seq is captured.
+
+        Returns (seq, frame); frame is None on timeout. frame is a pinned
+        FrameSlot (or a JpegFrame in pass-through mode) exposing read-only
+        pixels as frame.image; use it as a context manager or call release()
+        so its buffer can be recycled.
+        """
+        return self.bus.wait(last_seq, timeout)
+
+    def stop(self):
+        print("Stopping camera stream...")
+        self.stopped = True
+        self.bus.close()
+        if self.processing_thread.is_alive():
+            self.processing_thread.join(timeout=1.0)
+        self.stream.release()
@@ -0,0 +1,56 @@
+import sys
+import time
+import signal
+import argparse
+import cv2
+import numpy as np
+from camera import WebcamVideoStream, JpegFrame, as_image
+from shm_bus import SharedFrameWriter, DEFAULT_NAME, KIND_JPEG, KIND_RAW
+
+
+# Owns the camera and publishes every frame to shared memory, so final.py,
+# liveS.py and OpencvF.py can all run at once (started with
+# HEXAPOD_CAMERA=shared) without opening the device again.
+def serve(src=0, name=DEFAULT_NAME, passthrough=True):
+    camera = WebcamVideoStream(src, passthrough=passthrough)
+    width = int(camera.stream.get(cv2.CAP_PROP_FRAME_WIDTH)) or 640
+    height = int(camera.stream.get(cv2.CAP_PROP_FRAME_HEIGHT)) or 480
+    writer = SharedFrameWriter(name, slot_bytes=width * height * 3)
+    # Let systemd/kill stop the service cleanly, so the segment is removed
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print(f"Publishing camera {src} as shared memory '{name}'")
+
+    seq = 0
+    started = time.time()
+    try:
+        while not camera.stopped:
+            seq, frame = camera.wait_frame(seq)
+            if frame is None:
+                continue
+            with frame:
+                if isinstance(frame, JpegFrame):
+                    # Consumers decode only if they need pixels
+                    writer.publish(np.frombuffer(frame.jpeg, np.uint8), KIND_JPEG,
+                                   (height, width, 3), frame.timestamp)
+                else:
+                    image = as_image(frame)
+                    writer.publish(image, KIND_RAW, image.shape, frame.timestamp)
+            if seq % 300 == 0:
+                print(f"{seq} frames, {seq / (time.time() - started):.1f} fps, "
+                      f"{writer.frames_dropped} dropped")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        camera.stop()
+        writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Share one camera between the Hexapod apps")
+    parser.add_argument('--src', type=int, default=0, help="camera index")
+    parser.add_argument('--name', default=DEFAULT_NAME, help="shared memory segment name")
+    parser.add_argument('--decode', action='store_true',
+                        help="publish decoded BGR frames instead of the camera's JPEG")
+    args = parser.parse_args()
+    serve(args.src, args.name, passthrough=not args.decode)
+    sys.exit(0)
@@ -0,0 +1,225 @@
+import json
+import time
+from collections import namedtuple, OrderedDict
+from threading import Thread
+import cv2
+import numpy as np
+from framebus import FrameBus
+from camera import as_image
+
+# What the detectors found in one camera frame. seq and timestamp identify the
+# frame; objects maps each detector's name to its list of results;
+# detected_at says when the result was ready.
+DetectionResult = namedtuple('DetectionResult', ['seq', 'timestamp', 'objects', 'detected_at'])
+
+# Pass-through frames can be decoded straight to these pyramid levels
+_REDUCED_GRAY = {0: cv2.IMREAD_GRAYSCALE, 1: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                 2: cv2.IMREAD_REDUCED_GRAYSCALE_4, 3: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
+
+def _half(image):
+    # 2x2 averaging, like libjpeg's reduced decode, so a level looks the same
+    # (and the motion gate is as sensitive) however it was made. pyrDown's
+    # wider blur cuts frame-to-frame differences several times over.
+    return cv2.resize(image, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+
+
+# Per-frame image products shared by every detector. Each is computed on
+# first use and then reused, so adding a detector adds no conversion cost.
+# base is the finest pyramid level any consumer of the frame needs: a
+# pass-through JPEG is decoded once, straight to that level, and every
+# coarser level is scaled down from it, whichever level is asked for first.
+class FrameProducts:
+    def __init__(self, frame, base=0):
+        self.frame = frame
+        self.timestamp = getattr(frame, 'timestamp', 0.0)
+        self._jpeg = getattr(frame, 'jpeg', None)
+        self.base = min(base, max(_REDUCED_GRAY))
+        self._levels = {}
+
+    @property
+    def image(self):
+        """Full-resolution BGR pixels"""
+        return as_image(self.frame)
+
+    @property
+    def gray(self):
+        """Full-resolution grayscale, level 0 of the pyramid"""
+        return self.pyramid(0)
+
+    def pyramid(self, level):
+        """Grayscale image at 1/2**level of full resolution"""
+        image = self._levels.get(level)
+        if image is not None:
+            return image
+        if level > self.base:
+            image = _half(self.pyramid(level - 1))
+        elif self._jpeg is not None:
+            # Gray only, and libjpeg scales while decoding. Only a level finer
+            # than base costs a second decode.
+            image = cv2.imdecode(np.frombuffer(self._jpeg, np.uint8), _REDUCED_GRAY[level])
+        elif level == 0:
+            image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+        else:
+            image = _half(self.pyramid(level - 1))
+        self._levels[level] = image
+        return image
+
+
+# Pipeline entry for a detector that a ProcessDetectionWorker runs in its
+# process pool. The pipeline keeps its enable flag but never calls it; the
+# pool reads the flag and merges the pooled results with the pipeline's own.
+class PooledDetector:
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, products):
+        raise TypeError(f"Detector '{self.name}' runs in the process pool")
+
+
+# Ordered set of named detectors sharing one FrameProducts per frame. Each
+# detector is detect(products) -> list of results and can be switched on and
+# off on its own.
+class DetectorPipeline:
+    def __init__(self):
+        self.detectors = OrderedDict()
+        self.enabled = {}
+
+    def register(self, name, detect, enabled=True):
+        self.detectors[name] = detect
+        self.enabled[name] = enabled
+
+    def set_enabled(self, name, enabled):
+        """Switch one detector; returns its new state, or None if unknown"""
+        if name not in self.detectors:
+            return None
+        self.enabled[name] = bool(enabled)
+        return self.enabled[name]
+
+    @property
+    def active(self):
+        return any(self.enabled.values())
+
+    def __call__(self, products):
+        return {name: detect(products) for name, detect in self.detectors.items()
+                if self.enabled[name] and not isinstance(detect, PooledDetector)}
+
+
+# Runs a detector on its own thread so its cost never stalls capture or
+# streaming. It always takes the newest frame from the camera bus; frames that
+# arrive while a detection is running are skipped, never queued.
+class DetectionWorker:
+    def __init__(self, bus, detect, interval=0.0, gate=None, level=0):
+        self.source = bus         # Camera FrameBus handing out pinned frames
+        self.detect = detect      # detect(products) -> results, e.g. a DetectorPipeline
+        self.interval = interval  # Minimum seconds between detections
+        self.gate = gate          # Optional MotionGate checked before detect
+        self.level = level        # Finest pyramid level that detect and gate use
+        self.enabled = True
+        self.stopped = False
+
+        # Results are published with the sequence number of their frame
+        self.results = FrameBus()
+        self.frames_processed = 0
+        self.frames_skipped = 0
+        self.last_duration = 0.0
+
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+
+    def update(self):
+        seq = 0
+        while not self.stopped and not self.source.closed:
+            new_seq, frame = self.source.wait(seq, 1.0)
+            if frame is None:
+                continue
+            with frame:
+                if seq:
+                    self.frames_skipped += new_seq - seq - 1
+                seq = new_seq
+                if not self.enabled:
+                    continue
+                products = FrameProducts(frame, self.level)
+                # On a static scene the last result still holds, so keep it
+                if self.gate is not None and not self.gate.update(products):
+                    continue
+                started = time.time()
+                try:
+                    objects = self.detect(products)
+                except Exception as e:
+                    # One bad frame must not end detection for good
+                    print(f"Error in detection worker: {e}")
+                    continue
+                timestamp = frame.timestamp
+            self.last_duration = time.time() - started
+            self.frames_processed += 1
+            self.results.publish(DetectionResult(seq, timestamp, objects, time.time()), timestamp)
+
+            # Rate cap, so detection leaves CPU for everything else
+            remaining = self.interval - self.last_duration
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def latest(self):
+        """Return the most recent DetectionResult, or None"""
+        return self.results.latest()[1]
+
+    def stats(self):
+        stats = {'frames_processed': self.frames_processed,
+                 'frames_skipped': self.frames_skipped,
+                 'last_duration': self.last_duration}
+        if self.gate is not None:
+            stats.update(self.gate.stats())
+        return stats
+
+    def stop(self):
+        self.stopped = True
+        self.results.close()
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
+
+
+# Turns a detection worker's results into Server-Sent Events for every
+# dashboard at once. Each change is serialised a single time and published
+# on one bus; results identical to the last event are not sent again.
+class DetectionEvents:
+    def __init__(self, results, describe, keepalive=15.0):
+        self.results = results    # The worker's results FrameBus
+        self.describe = describe  # describe(DetectionResult) -> JSON-able dict
+        self.keepalive = keepalive
+        self.bus = FrameBus()     # Carries ready-to-send event bytes
+        self.events_sent = 0
+        self.stopped = False
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+
+    def update(self):
+        seq = 0
+        last = None
+        while not self.stopped and not self.results.closed:
+            seq, result = self.results.wait(seq, 1.0)
+            if result is None or result.objects == last:
+                continue
+            last = result.objects
+            payload = json.dumps(self.describe(result))
+            self.bus.publish(f"id: {result.seq}\ndata: {payload}\n\n".encode(), result.timestamp)
+            self.events_sent += 1
+        self.bus.close()
+
+    def stream(self):
+        """Generate the event stream for one client, starting with the latest"""
+        seq = 0
+        last_sent = time.time()
+        while not self.bus.closed:
+            seq, event = self.bus.wait(seq, 1.0)
+            if event is not None:
+                yield event
+                last_sent = time.time()
+            elif time.time() - last_sent >= self.keepalive:
+                # Comment line, so proxies do not close an idle connection
+                yield b': keepalive\n\n'
+                last_sent = time.time()
+
+    def stop(self):
+        self.stopped = True
+        self.bus.close()
@@ -0,0 +1,220 @@
+import cv2
+import time
+import numpy as np
+from contextlib import contextmanager
+from threading import Thread, Lock, Event
+from framebus import FrameBus
+from camera import JpegFrame, as_image
+from adaptive import AdaptiveStreamController
+
+
+def _part(jpeg_bytes):
+    return (b'--frame\r\n'
+            b'Content-Type: image/jpeg\r\n\r\n' + jpeg_bytes + b'\r\n')
+
+
+def draw_boxes(image, boxes, scale=1.0):
+    """Draw (x, y, w, h) boxes, given in full-resolution pixels, onto image"""
+    for (x, y, w, h) in boxes:
+        x, y, w, h = [int(v * scale) for v in (x, y, w, h)]
+        cv2.rectangle(image, (x, y), (x + w, y + h), (0, 255, 0), 2)
+
+
+# Encodes every new camera frame exactly once and fans the bytes out to all
+# /video_feed viewers, so encode cost stays flat as the viewer count grows.
+# overlay, if given, returns the boxes to draw on the frame being encoded;
+# they are drawn once here, on the live frame, for every viewer.
+class SharedJpegEncoder:
+    def __init__(self, camera, jpeg_quality=70, overlay=None):
+        self.camera = camera
+        self.overlay = overlay
+        self._scratch = None  # Reused buffer for drawing on raw frames
+        self.jpeg_quality = jpeg_quality
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]  # Lower quality = faster encoding
+        self.bus = FrameBus()  # Carries ready-to-send multipart parts
+        self.stopped = False
+        self.frames_encoded = 0
+        self.viewers = 0
+        self.lock = Lock()
+        self.has_viewers = Event()  # Encoder idles while nobody is watching
+
+        # Source of the newest part, kept pinned so degraded variants for
+        # adaptive clients can be encoded once per (quality, scale) and shared
+        self.source = None
+        self.variants = {}
+
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+
+    def update(self):
+        seq = 0
+        while not self.stopped:
+            if not self.has_viewers.wait(timeout=1.0):
+                continue
+            seq, frame = self.camera.wait_frame(seq)
+            if frame is None:
+                if self.camera.stopped:
+                    break
+                continue
+
+            boxes = self.overlay() if self.overlay is not None else None
+            if isinstance(frame, JpegFrame) and not boxes:
+                # Pass-through: the camera already compressed this frame
+                data = frame.jpeg
+            else:
+                image = self._drawable(frame) if boxes else as_image(frame)
+                if boxes:
+                    draw_boxes(image, boxes)
+                ret, jpeg = cv2.imencode('.jpg', image, self.encode_params)
+                if not ret:
+                    frame.release()
+                    continue
+                data = jpeg.tobytes()
+                self.frames_encoded += 1
+
+            # Only this thread publishes on self.bus, so the part's sequence
+            # number is known before it goes out
+            with self.lock:
+                previous, self.source = self.source, (self.bus.seq + 1, frame, boxes)
+                self.variants = {}
+            if previous is not None:
+                previous[1].release()
+            self.bus.publish(_part(data), frame.timestamp)
+
+        with self.lock:
+            previous, self.source = self.source, None
+        if previous is not None:
+            previous[1].release()
+        self.stopped = True
+        self.bus.close()
+
+    def encode_variant(self, seq, quality, scale):
+        """Return the part for frame seq at a lower quality/scale, encoding it
+        at most once per frame. Returns None if seq is no longer current."""
+        key = (quality, scale)
+        with self.lock:
+            if self.source is None or self.source[0] != seq:
+                return None
+            part = self.variants.get(key)
+            if part is not None:
+                return part
+            _, frame, boxes = self.source
+            frame.pin()
+
+        with frame:
+            image = as_image(frame)
+            if scale != 1.0:
+                image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            if boxes:
+                if scale == 1.0:
+                    image = image.copy()  # Never draw on the camera's buffer
+                draw_boxes(image, boxes, scale)
+            ret, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ret:
+            return None
+        part = _part(jpeg.tobytes())
+        with self.lock:
+            self.frames_encoded += 1
+            if self.source is not None and self.source[0] == seq:
+                self.variants[key] = part
+        return part
+
+    def _drawable(self, frame):
+        # Writable pixels for the overlay without touching the camera's
+        # buffers: a fresh decode for pass-through frames, else the scratch copy
+        if isinstance(frame, JpegFrame):
+            return cv2.imdecode(np.frombuffer(frame.jpeg, np.uint8), cv2.IMREAD_COLOR)
+        image = as_image(frame)
+        if self._scratch is None or self._scratch.shape != image.shape:
+            self._scratch = np.empty_like(image)
+        np.copyto(self._scratch, image)
+        return self._scratch
+
+    def wants_variant(self, controller):
+        """True if an adaptive client is currently below full quality"""
+        return controller is not None and (controller.quality < self.jpeg_quality
+                                           or controller.scale != 1.0)
+
+    @contextmanager
+    def viewer(self):
+        """Register a viewer for the lifetime of a /video_feed response"""
+        with self.lock:
+            self.viewers += 1
+            self.has_viewers.set()
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.viewers -= 1
+                if self.viewers == 0:
+                    self.has_viewers.clear()
+
+    def wait(self, last_seq=0, timeout=1.0):
+        """Block until an encoded part newer than last_seq exists"""
+        return self.bus.wait(last_seq, timeout)
+
+    def stream(self, controller=None):
+        """Generate multipart parts for one /video_feed client.
+
+        Without a controller every part is sent at full quality. With an
+        AdaptiveStreamController the client is paced to the controller's frame
+        rate and served the matching shared variant; because the bus only holds
+        the newest part, a slow client skips stale frames instead of queueing.
+        """
+        with self.viewer():
+            seq = 0
+            while True:
+                if controller is not None:
+                    controller.pace()
+                seq, part, timestamp = self.bus.wait_stamped(seq, 1.0)
+                if part is None:
+                    if self.stopped:
+                        return
+                    continue
+                if self.wants_variant(controller):
+                    part = self.encode_variant(seq, controller.quality, controller.scale)
+                    if part is None:
+                        continue
+
+                # The yield blocks for as long as the server takes to write the
+                # part, which is the backpressure the controller reacts to
+                started = time.time()
+                yield part
+                if controller is not None:
+                    controller.observe(time.time() - started, timestamp)
+
+    def stop(self):
+        self.stopped = True
+        self.has_viewers.set()
+        self.bus.close()
+
+
+# The process's one encoder for the app's camera, shared by every viewer of
+# every route. It is started on first use and restarted along with the
+# camera; overlay(camera), if given, returns the boxes callable for it.
+_shared = None
+_shared_lock = Lock()
+
+
+def get_shared_encoder(camera_getter, overlay=None):
+    """Return the shared SharedJpegEncoder for camera_getter()'s camera"""
+    global _shared
+    cam = camera_getter()
+    with _shared_lock:
+        if _shared is None or _shared.stopped or _shared.camera is not cam:
+            _shared = SharedJpegEncoder(cam, overlay=overlay(cam) if overlay is not None else None)
+        return _shared
+
+
+def stop_shared_encoder():
+    with _shared_lock:
+        if _shared is not None:
+            _shared.stop()
+
+
+def mjpeg_stream(encoder, adaptive=False):
+    """Multipart /video_feed body for one client"""
+    # Remote clients get their own controller that trades quality, size and
+    # frame rate for latency; LAN clients always get full quality
+    controller = AdaptiveStreamController() if adaptive else None
+    return encoder.stream(controller)
@@ -1,8 +1,14 @@
 from flask import Flask, request, jsonify, Response
 import serial
+import os
 import time
-import cv2
-from threading import Thread, Lock
+from threading import Lock
+from camera import WebcamVideoStream, camera_source
+from encoder import get_shared_encoder, stop_shared_encoder, mjpeg_stream
+from adaptive import is_local_client
+from serial_worker import SerialWorker
+from scheduler import MotionScheduler
+from gait import GaitEngine
 
 app = Flask(__name__)
 
@@ -19,15 +25,41 @@ except ImportError:
     auth_enabled = False
     print("flask_basicauth not installed, authentication disabled")
 
-# Initialize serial communication
+# Initialize serial communication. HEXAPOD_SERIAL_PORT can point this at
+# another port, such as the pty from arduino_emulator.py
+SERIAL_PORT = os.environ.get('HEXAPOD_SERIAL_PORT', '/dev/ttyUSB0')
 try:
-    ser = serial.Serial('/dev/ttyUSB0', 115200, timeout=1)
+    ser = serial.Serial(SERIAL_PORT, 115200, timeout=1)
     time.sleep(2)
     print("Serial connection established.")
 except serial.SerialException as e:
     print(f"Error: Could not open serial port. {e}")
     ser = None  # Still allow the app to run for camera-only usage
 
+# Hexapod_final.ino speaks the framed protocol in protocol.py; set this to
+# False for firmware that only understands bare command letters
+SERIAL_FRAMED = True
+
+# Streamed gait poses only carry the servos that changed, with a full pose
+# every so often; set this to False to send every pose in full
+SERIAL_DELTA_POSES = True
+
+# All serial traffic goes through one worker thread that owns the port
+serial_worker = (SerialWorker(ser, framed=SERIAL_FRAMED, delta_poses=SERIAL_DELTA_POSES)
+                 if ser is not None else None)
+
+# With HEXAPOD_GAIT=host the gaits are interpolated here and streamed to the
+# robot as whole poses, instead of running from the tables in the firmware;
+# HEXAPOD_GAIT=ik generates them from inverse kinematics instead
+GAIT_MODE = os.environ.get('HEXAPOD_GAIT', 'firmware')
+gait_engine = None
+if serial_worker is not None and SERIAL_FRAMED and GAIT_MODE in ('host', 'ik'):
+    gait_engine = GaitEngine(serial_worker, ik=GAIT_MODE == 'ik')
+    print(f"Host-side gait engine enabled ({GAIT_MODE})")
+
+# Timed motions ("move forward for 5 seconds") run in the background
+motion_scheduler = MotionScheduler(gait_engine or serial_worker) if serial_worker is not None else None
+
 # Predefined commands and their mappings
 COMMANDS = {
     "move forward": "F",
@@ -37,72 +69,24 @@ COMMANDS = {
     "stop": "S",
 }
 
-# Optimized Webcam class with minimal buffering and latency
-class WebcamVideoStream:
-    def __init__(self, src=0):
-        print("Initializing camera...")
-        self.stream = cv2.VideoCapture(src)
-        
-        # Aggressive camera optimization settings
-        self.stream.set(cv2.CAP_PROP_BUFFERSIZE, 1)      # Minimum buffer size
-        self.stream.set(cv2.CAP_PROP_FRAME_WIDTH, 640)   # Reasonable resolution
-        self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)  
-        self.stream.set(cv2.CAP_PROP_FPS, 30)            # Target FPS
-        
-        # Try to disable auto focus which can cause periodic delays
-        self.stream.set(cv2.CAP_PROP_AUTOFOCUS, 0)
-        
-        # For some cameras, lower quality can reduce latency
-        self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
-        
-        self.grabbed, self.frame = self.stream.read()
-        self.stopped = False
-        self.lock = Lock()  # Thread synchronization
-        
-        # Start the thread to read frames
-        Thread(target=self.update, daemon=True).start()
-        
-    def update(self):
-        last_frame_time = time.time()
-        while not self.stopped:
-            # Skip frames if we're running behind (helps reduce latency)
-            current_time = time.time()
-            if current_time - last_frame_time < 0.01:  # Max ~100fps internal processing
-                continue
-                
-            # Get the latest frame and clear the buffer
-            for _ in range(2):  # Try to clear any buffered frames
-                if self.stream.isOpened():
-                    grabbed, frame = self.stream.read()
-                    if grabbed:
-                        with self.lock:
-                            self.grabbed, self.frame = grabbed, frame
-            
-            last_frame_time = current_time
-            
-    def read(self):
-        with self.lock:
-            return self.frame.copy() if self.grabbed else None
-            
-    def stop(self):
-        print("Stopping camera stream...")
-        self.stopped = True
-        self.stream.release()
-
 # Global camera instance
 camera = None
+camera_lock = Lock()
 
 def get_camera():
     global camera
-    if camera is None or camera.stopped:
-        camera = WebcamVideoStream()
-        time.sleep(0.5)  # Short delay to ensure camera is initialized
+    with camera_lock:
+        if camera is None or camera.stopped:
+            camera = WebcamVideoStream(camera_source(), passthrough=True)
+            time.sleep(0.5)  # Short delay to ensure camera is initialized
     return camera
 
-# Route to serve the HTML interface
-@app.route('/')
-def index():
-    return '''
+# Shared encoder feeding every /video_feed viewer
+def get_encoder():
+    return get_shared_encoder(get_camera)
+
+# Dashboard page, served by both the Flask and the asyncio server
+INDEX_HTML = '''
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -230,12 +214,28 @@ def index():
                     });
                     const result = await response.json();
                     document.getElementById('response').innerText = result.response;
+                    if (result.id) {
+                        // The command is queued; show the Arduino's reply once it arrives
+                        setTimeout(() => showCommandStatus(result.id), 250);
+                    }
                 } catch (error) {
                     console.error("Error:", error);
                     document.getElementById('response').innerText = "Error: Could not send command";
                 }
             }
 
+            async function showCommandStatus(id) {
+                try {
+                    const response = await fetch('/command_status/' + id);
+                    const status = await response.json();
+                    if (status.response) {
+                        document.getElementById('response').innerText = status.response;
+                    }
+                } catch (error) {
+                    console.error("Error:", error);
+                }
+            }
+
             // Send text/voice command
             async function sendChatCommand() {
                 const userMessage = document.getElementById('chatInput').value;
@@ -351,29 +351,45 @@ def index():
     </html>
     '''
 
+# Route to serve the HTML interface
+@app.route('/')
+def index():
+    return INDEX_HTML
+
+# Basic control command handling; returns (payload, status)
+def run_command(data):
+    if serial_worker is None:
+        return {"response": "Serial not connected"}, 500
+        
+    data = data.upper()
+    if data in ['F', 'B', 'L', 'R', 'S']:
+        # Queue it and return at once; the reply can be fetched by id
+        entry = motion_scheduler.send(data)
+        return {"response": f"Command queued (#{entry.id}).", "id": entry.id}, 200
+    return {"response": "Unknown command"}, 400
+
 # Route to handle basic control commands
 @app.route('/send_command', methods=['POST'])
 def send_command():
-    if ser is None:
-        return jsonify({"response": "Serial not connected"}), 500
-        
-    data = request.json.get('command', '').upper()
-    if data in ['F', 'B', 'L', 'R', 'S']:
-        ser.write(data.encode())
-        time.sleep(0.1)
-        if ser.in_waiting > 0:
-            response = ser.readline().decode().strip()
-            return jsonify({"response": response})
-        return jsonify({"response": "Command sent."})
-    return jsonify({"response": "Unknown command"}), 400
+    payload, status = run_command(request.json.get('command', ''))
+    return jsonify(payload), status
 
-# Route to handle chat/voice commands
-@app.route('/chat_command', methods=['POST'])
-def chat_command():
-    if ser is None:
+# Route to look up a queued command and the Arduino's reply to it
+@app.route('/command_status/<int:command_id>')
+def command_status(command_id):
+    if serial_worker is None:
         return jsonify({"response": "Serial not connected"}), 500
+    status = serial_worker.status(command_id)
+    if status is None:
+        return jsonify({"response": "Unknown command id"}), 404
+    return jsonify(status)
+
+# Chat/voice command handling; returns (payload, status)
+def run_chat_command(user_message):
+    if serial_worker is None:
+        return {"response": "Serial not connected"}, 500
         
-    user_message = request.json.get('message', '').lower()
+    user_message = user_message.lower()
     
     # Parse the message for command and duration
     parts = user_message.split()
@@ -397,35 +413,60 @@ def chat_command():
     command = COMMANDS.get(command_key)
 
     if command:
-        ser.write(command.encode())
         if duration > 0:
-            time.sleep(duration)
-            ser.write("S".encode())
-            return jsonify({"response": f"Executed '{command_key}' for {duration} seconds."})
-        return jsonify({"response": f"Executed command: {command_key}."})
-
-    return jsonify({"response": "Command not recognized. Try 'move forward for 5 seconds'."})
-
-# Video streaming generator function
-def gen():
-    cam = get_camera()
-    jpeg_quality = 70  # Lower quality = faster encoding (adjust as needed)
-    encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
-    
-    while True:
-        frame = cam.read()
-        if frame is None:
-            time.sleep(0.01)  # Short sleep if frame not available
-            continue
-            
-        # Encode with optimized parameters
-        ret, jpeg = cv2.imencode('.jpg', frame, encode_params)
-        if not ret:
-            continue
-            
-        # Send frame immediately
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+            # The stop is scheduled, not slept on; a newer command cancels it
+            motion = motion_scheduler.start(command, duration)
+            return {"response": f"Executing '{command_key}' for {duration} seconds.",
+                    "motion_id": motion.id}, 200
+        motion_scheduler.send(command)
+        return {"response": f"Executed command: {command_key}."}, 200
+
+    return {"response": "Command not recognized. Try 'move forward for 5 seconds'."}, 200
+
+# Route to handle chat/voice commands
+@app.route('/chat_command', methods=['POST'])
+def chat_command():
+    payload, status = run_chat_command(request.json.get('message', ''))
+    return jsonify(payload), status
+
+# Routes to inspect or cancel a timed motion started by a chat command
+@app.route('/motion_status/<int:motion_id>')
+def motion_status(motion_id):
+    if motion_scheduler is None:
+        return jsonify({"response": "Serial not connected"}), 500
+    status = motion_scheduler.status(motion_id)
+    if status is None:
+        return jsonify({"response": "Unknown motion id"}), 404
+    return jsonify(status)
+
+@app.route('/cancel_motion/<int:motion_id>', methods=['POST'])
+def cancel_motion(motion_id):
+    if motion_scheduler is None:
+        return jsonify({"response": "Serial not connected"}), 500
+    status = motion_scheduler.cancel(motion_id)
+    if status is None:
+        return jsonify({"response": "Unknown motion id"}), 404
+    return jsonify(status)
+
+# Host gait parameters; returns (payload, status) like run_command
+def set_gait(data):
+    if gait_engine is None:
+        return {"response": "Host gaits are off; start with HEXAPOD_GAIT=host or ik"}, 500
+    try:
+        return gait_engine.set_params(data.get('step_time'), data.get('rate'), data.get('smoothing'),
+                                      data.get('height'), data.get('stride')), 200
+    except (TypeError, ValueError):
+        return {"response": "Gait parameters must be numbers"}, 400
+
+# Route to read or change stride speed and smoothing while walking
+@app.route('/gait', methods=['GET', 'POST'])
+def gait():
+    if request.method == 'POST':
+        payload, status = set_gait(request.json or {})
+        return jsonify(payload), status
+    if gait_engine is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(gait_engine.status(), enabled=True))
 
 # Route for video streaming
 @app.route('/video_feed')
@@ -437,12 +478,21 @@ def video_feed():
             return Response('Authentication required', 401,
                           {'WWW-Authenticate': 'Basic realm="Login Required"'})
     
-    return Response(gen(),
+    adaptive = not is_local_client(request.remote_addr, request.headers.get('X-Forwarded-For'))
+    
+    return Response(mjpeg_stream(get_encoder(), adaptive),
                    mimetype='multipart/x-mixed-replace; boundary=frame')
 
 # Cleanup function
 def cleanup():
     global camera, ser
+    if motion_scheduler is not None:
+        motion_scheduler.stop()
+    if gait_engine is not None:
+        gait_engine.stop()
+    if serial_worker is not None:
+        serial_worker.stop()
+    stop_shared_encoder()
     if camera is not None:
         camera.stop()
     if ser is not None:
@@ -0,0 +1,60 @@
+from collections import namedtuple
+
+# Python mirror of the constants and gait step sequences hard-coded in
+# Hexapod_final/Hexapod_final.ino. Keep the two in sync when the firmware's
+# calibration or gaits change.
+
+NUM_SERVOS = 18
+SERVO_PINS = (2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 20, 21)
+
+INITIAL_ANGLES = (
+    90, 158, 145,  # L1, L2, L3
+    90, 160, 145,  # L4, L5, L6
+    90, 160, 140,  # L7, L8, L9
+    90, 140, 140,  # R1, R2, R3
+    90, 150, 140,  # R4, R5, R6
+    90, 165, 145,  # R7, R8, R9
+)
+
+DEFAULT_SPEED = 300  # ms the firmware waits between gait steps
+
+DIRECTION_NAMES = {'F': "Forward", 'B': "Backward", 'L': "Left", 'R': "Right"}
+
+# One block of servos[i].write() calls; delay says whether the firmware
+# follows it with delay(speed)
+GaitStep = namedtuple('GaitStep', ['writes', 'delay'])
+
+# Shared steps of the tripod gait. Group A is lifted first, swung, lowered,
+# then group B does the same while A returns to centre.
+_LIFT_A = {1: 180, 2: 90, 7: 180, 8: 90, 13: 180, 14: 90}
+_LOWER_A = {1: 158, 2: 145, 7: 160, 8: 140, 13: 150, 14: 140}
+_CENTER_A_LIFT_B = {0: 90, 6: 90, 12: 90, 4: 180, 5: 90, 10: 180, 11: 90, 16: 180, 17: 90}
+_CENTER_B_LIFT_A = {3: 90, 9: 90, 15: 90, **_LIFT_A}
+
+# Femurs of tripod B (L2, R1, R3), which sit at 180 while those legs are lifted
+TRIPOD_B_FEMURS = (4, 10, 16)
+
+
+def tripod_b_lifted(angles):
+    return any(angles[servo] == 180 for servo in TRIPOD_B_FEMURS)
+
+
+def _cycle(swing_a, swing_b, tibia_10):
+    lower_b = {4: 160, 5: 145, 10: tibia_10, 11: 150, 16: 165, 17: 145}
+    steps = [_LIFT_A, swing_a, _LOWER_A, _CENTER_A_LIFT_B, swing_b, lower_b, _CENTER_B_LIFT_A]
+    # Every step but the last is followed by delay(speed)
+    return tuple(GaitStep(tuple(step.items()), i < len(steps) - 1) for i, step in enumerate(steps))
+
+
+# move_forward(), move_backward(), turn_left() and turn_right()
+GAIT_STEPS = {
+    'F': _cycle({0: 120, 6: 120, 12: 60}, {3: 120, 9: 60, 15: 60}, 145),
+    'B': _cycle({0: 60, 6: 60, 12: 120}, {3: 60, 9: 130, 15: 120}, 145),
+    'L': _cycle({0: 60, 6: 60, 12: 60}, {3: 60, 9: 60, 15: 60}, 135),
+    'R': _cycle({0: 120, 6: 120, 12: 120}, {3: 120, 9: 120, 15: 120}, 135),
+}
+
+
+def cycle_duration(direction, speed=DEFAULT_SPEED):
+    """Seconds the firmware spends on one gait cycle"""
+    return sum(step.delay for step in GAIT_STEPS[direction]) * speed / 1000.0
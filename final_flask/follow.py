@@ -0,0 +1,121 @@
+import time
+from collections import deque
+from threading import Thread, Lock
+
+
+# Closed-loop "follow me": turns the newest face detection into L/R/F/S
+# commands on a fixed-rate loop, all on the robot. The largest face is
+# steered towards the centre of the frame and approached until it fills
+# target_area of it. Deadbands keep the robot still around the target, and
+# hysteresis keeps it from flapping between commands at their edges.
+class FaceFollower:
+    def __init__(self, results, send, frame_size, rate=10.0, deadband=0.15,
+                 hysteresis=0.05, target_area=0.06, lost_timeout=1.0, history=100):
+        self.results = results        # Detection results FrameBus
+        self.send = send              # send(command) -> SerialCommand
+        self.frame_size = frame_size  # frame_size() -> (width, height)
+        self.period = 1.0 / rate
+        self.deadband = deadband      # Horizontal offset (fraction of width) left alone
+        self.hysteresis = hysteresis
+        self.target_area = target_area
+        self.lost_timeout = lost_timeout  # Stop when the last face is older than this
+
+        self.enabled = False
+        self.stopped = False
+        self.command = 'S'
+        self.commands_sent = 0
+        self.overruns = 0   # Loop iterations that missed their slot
+        self.last_seq = 0
+
+        # See-to-act latency: frame capture to the robot acknowledging the
+        # command it caused
+        self.lock = Lock()
+        self.latencies = deque(maxlen=history)
+
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+
+    def set_enabled(self, enabled):
+        # The loop thread stops the robot when following is switched off
+        self.enabled = bool(enabled)
+        return self.enabled
+
+    def update(self):
+        next_tick = time.monotonic()
+        while not self.stopped:
+            if self.enabled:
+                self._step()
+            elif self.command != 'S':
+                self._send('S', None)
+            next_tick += self.period
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                self.overruns += 1
+                next_tick = time.monotonic()
+
+    def _step(self):
+        seq, result = self.results.latest()
+        faces = result.objects.get('faces') if result is not None else None
+        self.last_seq = seq
+        if not faces or time.time() - result.timestamp > self.lost_timeout:
+            # Nothing current to react to, so no latency to measure either
+            command, captured = 'S', None
+        else:
+            command = self._decide(max(faces, key=lambda face: face[2] * face[3]))
+            captured = result.timestamp
+        if command != self.command:
+            self._send(command, captured)
+
+    def _decide(self, face):
+        width, height = self.frame_size()
+        x, y, w, h = face
+        offset = (x + w / 2.0) / width - 0.5  # -0.5 (far left) .. 0.5 (far right)
+        area = (w * h) / float(width * height)
+
+        # Once turning, keep turning until well inside the deadband
+        turning = self.command in ('L', 'R')
+        limit = self.deadband - self.hysteresis if turning else self.deadband
+        if offset < -limit:
+            return 'L'
+        if offset > limit:
+            return 'R'
+
+        # Centred: walk up to the face, and once walking, keep going until
+        # clearly close enough
+        walking = self.command == 'F'
+        target = self.target_area * (1 + self.hysteresis) if walking else self.target_area
+        return 'F' if area < target else 'S'
+
+    def _send(self, command, captured):
+        self.command = command
+        entry = self.send(command)
+        self.commands_sent += 1
+        if captured is not None and entry is not None:
+            entry.future.add_done_callback(lambda _: self._record(entry, captured))
+
+    def _record(self, entry, captured):
+        if entry.state == 'superseded':
+            return  # Never reached the robot
+        acted = entry.acked if entry.acked is not None else time.time()
+        with self.lock:
+            self.latencies.append(acted - captured)
+
+    def status(self):
+        with self.lock:
+            last = self.latencies[-1] if self.latencies else None
+            latencies = sorted(self.latencies)
+        status = {'enabled': self.enabled, 'command': self.command,
+                  'commands_sent': self.commands_sent, 'overruns': self.overruns,
+                  'result_seq': self.last_seq}
+        if latencies:
+            status['latency_last'] = last
+            status['latency_p50'] = latencies[len(latencies) // 2]
+            status['latency_p95'] = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+        return status
+
+    def stop(self):
+        self.stopped = True
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
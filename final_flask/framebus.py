@@ -0,0 +1,128 @@
+import time
+import numpy as np
+from threading import Condition, Lock
+
+
+# One preallocated frame buffer in a FrameRing. The capture thread writes into
+# buffer in place; readers only ever see the read-only image view and must
+# release() it (or use it as a context manager) when done.
+class FrameSlot:
+    def __init__(self, ring, buffer):
+        self.ring = ring
+        self.buffer = buffer
+        self.image = buffer.view()
+        self.image.flags.writeable = False
+        self.refs = 0
+        self.timestamp = 0.0  # Capture time of the pixels currently in buffer
+
+    def pin(self):
+        self.ring.pin(self)
+
+    def release(self):
+        self.ring.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# Fixed ring of frame buffers. A slot is only handed back to the writer once
+# every reader has released it, so nothing is allocated per frame.
+class FrameRing:
+    def __init__(self, shape, slots=4, dtype=np.uint8):
+        self.lock = Lock()
+        self.slots = [FrameSlot(self, np.empty(shape, dtype)) for _ in range(slots)]
+        self.shape = tuple(shape)
+        self.dropped = 0  # Frames skipped because readers held every slot
+        self._next = 0
+
+    def claim(self):
+        """Return a free slot pinned for the writer, or None if all are in use"""
+        with self.lock:
+            for i in range(len(self.slots)):
+                index = (self._next + i) % len(self.slots)
+                slot = self.slots[index]
+                if slot.refs == 0:
+                    slot.refs = 1
+                    self._next = (index + 1) % len(self.slots)
+                    return slot
+            self.dropped += 1
+            return None
+
+    def pin(self, slot):
+        with self.lock:
+            slot.refs += 1
+
+    def release(self, slot):
+        with self.lock:
+            slot.refs -= 1
+
+
+# Latest-value frame bus shared between the capture thread and its consumers
+class FrameBus:
+    def __init__(self, pin=None):
+        self._cond = Condition()
+        # Called under the bus lock on every frame handed to a consumer, so a
+        # ring slot is pinned before the writer can recycle it
+        self._pin = pin
+        self._seq = 0
+        self._frame = None
+        self._timestamp = 0.0
+        self.closed = False
+
+    def publish(self, frame, timestamp=None):
+        """Publish a new frame and wake every waiting consumer"""
+        with self._cond:
+            self._seq += 1
+            self._frame = frame
+            self._timestamp = time.time() if timestamp is None else timestamp
+            self._cond.notify_all()
+            return self._seq
+
+    def latest(self):
+        """Return (seq, frame) for the most recent frame without blocking"""
+        with self._cond:
+            return self._seq, self._take()
+
+    def wait(self, last_seq=0, timeout=None):
+        """Block until a frame newer than last_seq exists.
+
+        Returns (seq, frame). On timeout or close, returns (last_seq, None)
+        so callers can simply loop with the sequence number they hold.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > last_seq or self.closed, timeout)
+            if self._seq > last_seq:
+                return self._seq, self._take()
+            return last_seq, None
+
+    def wait_stamped(self, last_seq=0, timeout=None):
+        """Like wait(), but returns (seq, frame, timestamp) read atomically"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > last_seq or self.closed, timeout)
+            if self._seq > last_seq:
+                return self._seq, self._take(), self._timestamp
+            return last_seq, None, 0.0
+
+    def _take(self):
+        if self._pin is not None and self._frame is not None:
+            self._pin(self._frame)
+        return self._frame
+
+    @property
+    def seq(self):
+        with self._cond:
+            return self._seq
+
+    @property
+    def timestamp(self):
+        with self._cond:
+            return self._timestamp
+
+    def close(self):
+        """Release every waiting consumer, e.g. when the camera stops"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
@@ -0,0 +1,277 @@
+import time
+from collections import OrderedDict
+from threading import Thread, Lock
+import numpy as np
+from firmware_model import GAIT_STEPS, INITIAL_ANGLES, DEFAULT_SPEED
+from serial_worker import DIRECTION_COMMANDS
+import kinematics
+
+
+def keyframes(direction, start=INITIAL_ANGLES):
+    """Poses held during each step of one steady-state gait cycle, shape (steps, 18).
+
+    The firmware writes a step's angles and then waits delay(speed); a step
+    without a delay is held only until the next one, so it folds into it.
+    """
+    pose = np.array(start, np.float32)
+    held = []
+    for cycle in range(2):  # The first cycle only gets from start into the gait
+        for step in GAIT_STEPS[direction]:
+            for servo, angle in step.writes:
+                pose[servo] = angle
+            if cycle and step.delay:
+                held.append(pose.copy())
+    return np.array(held)
+
+
+def _ease(fraction, smoothing):
+    # 0 moves at constant speed between keyframes; 1 eases in and out of each
+    return (1 - smoothing) * fraction + smoothing * (1 - np.cos(np.pi * fraction)) / 2
+
+
+def trajectory(keys, step_time, rate, smoothing=1.0):
+    """Interpolate a cycle of keyframes into uint8 poses, one per 1/rate seconds.
+
+    Pose k of keys is reached at k * step_time, when the firmware would have
+    jumped to it, and the cycle wraps back to keys[0].
+    """
+    steps = len(keys)
+    frames = max(steps, int(round(steps * step_time * rate)))
+    phase = np.arange(frames) * (steps / float(frames))  # In keyframes
+    index = phase.astype(int)
+    start, end = keys[index], keys[(index + 1) % steps]
+    blend = _ease(phase - index, smoothing)[:, None]
+    return np.rint(start + (end - start) * blend).astype(np.uint8)
+
+
+def transition(current, target, frames, smoothing=1.0):
+    """Poses leading from current towards target, excluding both ends"""
+    current = np.asarray(current, np.float32)
+    target = np.asarray(target, np.float32)
+    blend = _ease(np.arange(1, frames) / float(frames), smoothing)[:, None]
+    return np.rint(current + (target - current) * blend).astype(np.uint8)
+
+
+# Bounded LRU store of generated gait cycles, as read-only uint8 arrays of
+# shape (frames, 18), about 1.6 kB for a 90-pose cycle. Cycles are keyed by
+# every parameter that shapes them, so tapping between directions, or back
+# to an earlier speed, replays a stored cycle instead of regenerating it.
+class GaitCache:
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._cycles = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.warmed = 0          # Cycles built ahead of time by warm()
+        self.last_build = 0.0    # Seconds the last cycle took to generate
+
+    def get(self, key, build):
+        """Return the cycle for key, calling build(key) to make it on a miss"""
+        with self._lock:
+            cycle = self._cycles.get(key)
+            if cycle is not None:
+                self._cycles.move_to_end(key)
+                self.hits += 1
+                return cycle
+            self.misses += 1
+        return self._store(key, build)
+
+    def warm(self, keys, build):
+        """Build any of keys not cached yet, without counting them as misses"""
+        for key in keys:
+            with self._lock:
+                if key in self._cycles:
+                    continue
+            self._store(key, build)
+            self.warmed += 1
+
+    def _store(self, key, build):
+        # Built outside the lock; a cycle takes well under a millisecond
+        started = time.perf_counter()
+        cycle = np.ascontiguousarray(build(key), np.uint8)
+        cycle.setflags(write=False)  # Shared by every reader of the cache
+        self.last_build = time.perf_counter() - started
+        with self._lock:
+            self._cycles[key] = cycle
+            self._cycles.move_to_end(key)
+            while len(self._cycles) > self.maxsize:
+                self._cycles.popitem(last=False)
+        return cycle
+
+    def stats(self):
+        with self._lock:
+            size = sum(cycle.nbytes for cycle in self._cycles.values())
+            entries = len(self._cycles)
+        return {'entries': entries, 'bytes': size, 'hits': self.hits, 'misses': self.misses,
+                'warmed': self.warmed, 'last_build_ms': self.last_build * 1000.0}
+
+
+# Walks the robot from the host: the firmware's gait tables, interpolated
+# into smooth trajectories and streamed as whole 18-servo poses ('P' frames)
+# on a fixed-rate loop. Stride speed (step_time), frame rate and smoothing
+# are runtime parameters instead of constants in the sketch. submit() takes
+# the same direction letters as SerialWorker, so MotionScheduler can drive
+# it unchanged. With ik=True the cycles come from kinematics.py instead of
+# the firmware's tables, so body height and stride become parameters too.
+class GaitEngine:
+    def __init__(self, serial_worker, rate=50.0, step_time=DEFAULT_SPEED / 1000.0,
+                 smoothing=1.0, ik=False, height=kinematics.DEFAULT_HEIGHT, stride=40.0,
+                 clock=time):
+        self.serial_worker = serial_worker
+        self.clock = clock            # monotonic()/sleep(); simulator.SimClock runs faster
+        self.rate = rate              # Poses sent per second
+        self.step_time = step_time    # Seconds per gait step; the firmware's speed
+        self.smoothing = smoothing    # 0 (linear) .. 1 (eased) between keyframes
+        self.ik = ik
+        self.height = height          # IK only: body above the ground, mm
+        self.stride = stride          # IK only: body travel per half cycle, mm
+        self.keys = {direction: keyframes(direction) for direction in GAIT_STEPS}
+        self.cache = GaitCache()
+
+        self.direction = 'S'
+        self.pose = np.array(INITIAL_ANGLES, np.uint8)  # Last pose sent
+        self._cycle = None     # Poses of the current gait cycle
+        self._index = 0
+        self._lead_in = []     # Transition poses still to send first
+
+        self.lock = Lock()
+        self.stopped = False
+        self.frames_sent = 0
+        self.frames_unchanged = 0  # Ticks whose pose matched the last one sent
+        self.cycles = 0
+        self.overruns = 0
+
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+        self._warm()
+
+    def _cycle_key(self, direction):
+        # Rounded below what the servos can show, so nearby settings share a cycle
+        return (direction, self.ik, round(self.step_time, 2), int(round(self.rate)),
+                round(self.smoothing, 2), int(round(self.height)), int(round(self.stride)))
+
+    def _build_cycle(self, key):
+        direction, ik, step_time, rate, smoothing, height, stride = key
+        keys = self.keys[direction]
+        if ik:
+            # Same cadence as the table gaits: one cycle is len(keys) steps
+            frames = max(len(keys), int(round(len(keys) * step_time * rate)))
+            # Legs that cannot reach the full lift swing lower instead
+            lifts = kinematics.fit_lift(direction, frames, height, stride)
+            poses, clamped = kinematics.solve_clamped(
+                kinematics.cycle_targets(direction, frames, height, stride, lifts))
+            servos = np.nonzero(clamped.any(axis=0))[0]
+            if len(servos):
+                # Out of range even with the foot down: height or stride is too large
+                print(f"Warning: IK gait {direction} (height {height}, stride {stride}) clamps "
+                      + ", ".join(kinematics.servo_name(servo) for servo in servos))
+            return np.rint(poses)
+        return trajectory(keys, step_time, rate, smoothing)
+
+    def _trajectory(self, direction):
+        return self.cache.get(self._cycle_key(direction), self._build_cycle)
+
+    def _warm(self):
+        # Have every direction ready for the current parameters, so a switch
+        # from the dashboard streams at once
+        with self.lock:
+            keys = [self._cycle_key(direction) for direction in GAIT_STEPS]
+        Thread(target=self.cache.warm, args=(keys, self._build_cycle), daemon=True).start()
+
+    def _standing(self):
+        if self.ik:
+            return np.rint(kinematics.solve(kinematics.default_stance(self.height))).astype(np.uint8)
+        return np.array(INITIAL_ANGLES, np.uint8)
+
+    def submit(self, command):
+        """Switch gait (F/B/L/R) or stand (S); returns the SerialCommand of its first pose.
+
+        Anything that is not a direction goes straight to the serial worker.
+        """
+        if command not in DIRECTION_COMMANDS:
+            return self.serial_worker.submit(command)
+        with self.lock:
+            self.direction = command
+            if command in self.keys:
+                self._cycle = self._trajectory(command)
+                target = self._cycle[0]
+            else:
+                self._cycle = None
+                target = self._standing()
+            self._index = 0
+            # Ease from wherever the legs are into the new gait over one step
+            lead_in = transition(self.pose, target, max(2, int(round(self.step_time * self.rate))),
+                                 self.smoothing)
+            self._lead_in = list(lead_in[1:]) + ([] if self._cycle is not None else [target])
+            return self._send(lead_in[0], force=True)
+
+    def set_params(self, step_time=None, rate=None, smoothing=None, height=None, stride=None):
+        """Change stride speed, frame rate, smoothing, body height or stride while walking"""
+        with self.lock:
+            if step_time is not None:
+                self.step_time = max(0.05, float(step_time))
+            if rate is not None:
+                self.rate = min(100.0, max(5.0, float(rate)))
+            if smoothing is not None:
+                self.smoothing = min(1.0, max(0.0, float(smoothing)))
+            if height is not None:
+                self.height = min(140.0, max(30.0, float(height)))
+            if stride is not None:
+                self.stride = min(80.0, max(0.0, float(stride)))
+            if self._cycle is not None:
+                # Carry on from the same point of the cycle
+                position = self._index / float(len(self._cycle))
+                self._cycle = self._trajectory(self.direction)
+                self._index = int(position * len(self._cycle))
+        self._warm()
+        return self.status()
+
+    def update(self):
+        next_tick = self.clock.monotonic()
+        while not self.stopped:
+            with self.lock:
+                pose = self._next_pose()
+                if pose is not None:
+                    self._send(pose)
+                period = 1.0 / self.rate
+            next_tick += period
+            delay = next_tick - self.clock.monotonic()
+            if delay > 0:
+                self.clock.sleep(delay)
+            else:
+                self.overruns += 1
+                next_tick = self.clock.monotonic()
+
+    def _next_pose(self):
+        if self._lead_in:
+            return self._lead_in.pop(0)
+        if self._cycle is None:
+            return None  # Standing; the firmware holds the last pose
+        pose = self._cycle[self._index]
+        self._index += 1
+        if self._index == len(self._cycle):
+            self._index = 0
+            self.cycles += 1
+        return pose
+
+    def _send(self, pose, force=False):
+        if not force and np.array_equal(pose, self.pose):
+            self.frames_unchanged += 1
+            return None
+        self.pose = np.array(pose, np.uint8)
+        self.frames_sent += 1
+        return self.serial_worker.submit_pose(self.pose.tolist())
+
+    def status(self):
+        return {'direction': self.direction, 'step_time': self.step_time, 'rate': self.rate,
+                'smoothing': self.smoothing, 'planner': 'ik' if self.ik else 'table',
+                'height': self.height, 'stride': self.stride, 'frames_sent': self.frames_sent,
+                'frames_unchanged': self.frames_unchanged, 'cycles': self.cycles,
+                'overruns': self.overruns, 'pose': self.pose.tolist(),
+                'cache': self.cache.stats(), 'link': self.serial_worker.pose_stats()}
+
+    def stop(self):
+        self.stopped = True
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
@@ -0,0 +1,219 @@
+import time
+import argparse
+import numpy as np
+from firmware_model import INITIAL_ANGLES
+
+# Inverse kinematics for all six legs at once. Foot targets are (..., 6, 3)
+# arrays in the body frame, in mm: x forward, y left, z up, origin at the
+# centre of the body. Leading dimensions batch whole trajectories, so a gait
+# cycle is solved in one call. Legs are in servo order: L1, L2, L3 (front to
+# rear), then R1, R2, R3.
+#
+# PLACEHOLDER GEOMETRY: the link lengths and leg mounts below were never
+# measured on this robot; they are plausible values for a hexapod of its
+# size. Measure the real links and mounts before relying on HEXAPOD_GAIT=ik.
+# As they stand they do not fit the calibrated servos everywhere: R3's femur
+# has only 15 degrees above its standing angle, so gait_cycle() lowers each
+# leg's lift to what its joints can reach (fit_lift()), and solve_clamped()
+# reports whatever is still out of range.
+#
+# Servo angles are calibrated against INITIAL_ANGLES: the standing stance
+# (default_stance()) maps exactly onto the firmware's initialAngles, and
+# every other pose is an offset from there.
+COXA_LENGTH = 30.0
+FEMUR_LENGTH = 60.0
+TIBIA_LENGTH = 90.0
+
+# Where each coxa joint sits on the body, and the way the leg points
+LEG_MOUNTS = np.array([(70, 50), (0, 50), (-70, 50), (70, -50), (0, -50), (-70, -50)], np.float32)
+LEG_YAW = np.radians([90, 90, 90, -90, -90, -90]).astype(np.float32)
+
+DEFAULT_HEIGHT = 80.0  # Body above the ground
+DEFAULT_REACH = 100.0  # Foot out from its coxa joint, in the standing stance
+
+# Servo degrees per joint degree for coxa, femur and tibia. A coxa servo
+# rises as the foot swings clockwise seen from above; femur and tibia rise
+# as the leg lifts and straightens.
+SERVO_SIGNS = np.array([-1.0, 1.0, 1.0], np.float32)
+
+# How far each joint may turn either side of its initialAngles calibration
+JOINT_RANGE = np.array([60.0, 60.0, 75.0], np.float32)
+
+_INITIAL = np.array(INITIAL_ANGLES, np.float32).reshape(6, 3)
+_LOWER = np.maximum(0.0, _INITIAL - JOINT_RANGE)
+_UPPER = np.minimum(180.0, _INITIAL + JOINT_RANGE)
+_COS_YAW, _SIN_YAW = np.cos(LEG_YAW), np.sin(LEG_YAW)
+
+LEG_NAMES = ('L1', 'L2', 'L3', 'R1', 'R2', 'R3')
+JOINT_NAMES = ('coxa', 'femur', 'tibia')
+
+# Tripod groups, as in the firmware: L1, L3 and R2 step together, then L2, R1, R3
+TRIPOD_A = np.array([True, False, True, False, True, False])
+
+
+def default_stance(height=DEFAULT_HEIGHT, reach=DEFAULT_REACH):
+    """Foot positions of the standing stance, shape (6, 3)"""
+    feet = np.empty((6, 3), np.float32)
+    feet[:, 0] = LEG_MOUNTS[:, 0] + reach * _COS_YAW
+    feet[:, 1] = LEG_MOUNTS[:, 1] + reach * _SIN_YAW
+    feet[:, 2] = -height
+    return feet
+
+
+def joint_angles(targets):
+    """Coxa yaw, femur elevation and tibia knee angle (radians) for foot targets.
+
+    Returns (joints, reachable): joints has the shape of targets, and
+    reachable is False for feet out of the leg's reach, which are solved as
+    if pulled back within it.
+    """
+    targets = np.asarray(targets, np.float32)
+    dx = targets[..., 0] - LEG_MOUNTS[:, 0]
+    dy = targets[..., 1] - LEG_MOUNTS[:, 1]
+    # Into each leg's own frame: out along the leg, then sideways
+    out = dx * _COS_YAW + dy * _SIN_YAW
+    side = dy * _COS_YAW - dx * _SIN_YAW
+    coxa = np.arctan2(side, out)
+
+    r = np.hypot(out, side) - COXA_LENGTH
+    z = targets[..., 2]
+    d = np.hypot(r, z)
+    shortest = abs(FEMUR_LENGTH - TIBIA_LENGTH) + 1e-3
+    longest = FEMUR_LENGTH + TIBIA_LENGTH - 1e-3
+    reachable = (d >= shortest) & (d <= longest)
+    d = np.clip(d, shortest, longest)
+
+    femur = np.arctan2(z, r) + np.arccos(np.clip(
+        (FEMUR_LENGTH ** 2 + d ** 2 - TIBIA_LENGTH ** 2) / (2 * FEMUR_LENGTH * d), -1, 1))
+    tibia = np.arccos(np.clip(
+        (FEMUR_LENGTH ** 2 + TIBIA_LENGTH ** 2 - d ** 2) / (2 * FEMUR_LENGTH * TIBIA_LENGTH), -1, 1))
+    return np.stack((coxa, femur, tibia), axis=-1), reachable
+
+
+# Joint angles of the standing stance, where the servos sit at initialAngles
+_NEUTRAL = np.degrees(joint_angles(default_stance())[0])
+
+
+def solve(targets):
+    """Servo angles in degrees, shape (..., 18), for foot targets of shape (..., 6, 3).
+
+    Each angle is clamped to its joint's range around initialAngles and to
+    the servo's 0-180.
+    """
+    return solve_clamped(targets)[0]
+
+
+def solve_clamped(targets):
+    """solve(), plus a bool array of the same shape marking angles that were clamped"""
+    joints = np.degrees(joint_angles(targets)[0])
+    servos = _INITIAL + SERVO_SIGNS * (joints - _NEUTRAL)
+    clamped = (servos < _LOWER) | (servos > _UPPER)
+    servos = np.clip(servos, _LOWER, _UPPER)
+    shape = servos.shape[:-2] + (18,)
+    return servos.reshape(shape), clamped.reshape(shape)
+
+
+def servo_name(servo):
+    """Leg and joint of a servo number, e.g. 'R3 femur'"""
+    return f"{LEG_NAMES[servo // 3]} {JOINT_NAMES[servo % 3]}"
+
+
+def forward(angles):
+    """Foot positions, shape (..., 6, 3), for servo angles of shape (..., 18)"""
+    servos = np.asarray(angles, np.float32).reshape(np.shape(angles)[:-1] + (6, 3))
+    coxa, femur, tibia = np.moveaxis(np.radians(_NEUTRAL + (servos - _INITIAL) / SERVO_SIGNS), -1, 0)
+    shin = femur - np.pi + tibia  # Tibia direction, down from the knee
+    r = COXA_LENGTH + FEMUR_LENGTH * np.cos(femur) + TIBIA_LENGTH * np.cos(shin)
+    z = FEMUR_LENGTH * np.sin(femur) + TIBIA_LENGTH * np.sin(shin)
+    yaw = LEG_YAW + coxa
+    return np.stack((LEG_MOUNTS[:, 0] + r * np.cos(yaw), LEG_MOUNTS[:, 1] + r * np.sin(yaw), z),
+                    axis=-1)
+
+
+def tripod_targets(frames, height=DEFAULT_HEIGHT, stride=40.0, heading=0.0, turn=0.0,
+                   lift=20.0, reach=DEFAULT_REACH):
+    """Foot targets for one tripod gait cycle, shape (frames, 6, 3).
+
+    lift is the swing height (mm), one for all legs or one per leg. Tripod A swings through the first half of the cycle while B pushes the
+    body along, then they swap. stride is how far the body moves per half
+    cycle (mm) in the heading direction (radians, 0 is forward, pi/2 left);
+    turn is how far it rotates per half cycle (radians, positive to the left).
+    """
+    stance = default_stance(height, reach)
+    phase = np.arange(frames, dtype=np.float32) / frames
+    # Progress of each leg through its own swing (0..1), or -1 when on the ground
+    half = (phase < 0.5)[:, None]
+    swing = np.where(half == TRIPOD_A, (phase[:, None] % 0.5) * 2, -1.0)
+    # Each foot runs from -0.5 to 0.5 of a stride while swinging, and back
+    # while it carries the body
+    s = np.where(swing >= 0, swing - 0.5, 0.5 - (phase[:, None] % 0.5) * 2)
+
+    angle = s * turn
+    cos, sin = np.cos(angle), np.sin(angle)
+    x = stance[:, 0] * cos - stance[:, 1] * sin + s * stride * np.cos(heading)
+    y = stance[:, 0] * sin + stance[:, 1] * cos + s * stride * np.sin(heading)
+    z = stance[:, 2] + lift * np.sin(np.pi * np.clip(swing, 0, 1))
+    return np.stack((x, y, z), axis=-1)
+
+
+# Direction letters as tripod walks: (heading, turning)
+DIRECTION_WALKS = {'F': (0.0, 0), 'B': (np.pi, 0), 'L': (0.0, 1), 'R': (0.0, -1)}
+
+
+def cycle_targets(direction, frames, height=DEFAULT_HEIGHT, stride=40.0, lift=20.0):
+    """Foot targets (frames, 6, 3) of one gait cycle for F, B, L or R.
+
+    Turns use stride as the distance the feet travel around the body.
+    """
+    heading, turning = DIRECTION_WALKS[direction]
+    if turning:
+        radius = np.hypot(*default_stance(height)[0, :2])
+        return tripod_targets(frames, height, 0.0, turn=turning * stride / radius, lift=lift)
+    return tripod_targets(frames, height, stride, heading, lift=lift)
+
+
+def fit_lift(direction, frames, height=DEFAULT_HEIGHT, stride=40.0, lift=20.0, iterations=6):
+    """Per-leg lift, shape (6,): lift, or less for a leg whose joints would leave their range.
+
+    Each leg's lift only moves that leg's joints, so all six are bisected at once.
+    """
+    def fits(lifts):
+        _, clamped = solve_clamped(cycle_targets(direction, frames, height, stride, lifts))
+        return ~clamped.reshape(frames, 6, 3).any(axis=(0, 2))
+
+    high = np.full(6, float(lift), np.float32)
+    if fits(high).all():
+        return high
+    low = np.zeros(6, np.float32)
+    done = fits(high)
+    for _ in range(iterations):
+        middle = (low + high) / 2
+        ok = fits(middle)
+        low = np.where(ok, middle, low)
+        high = np.where(ok, high, middle)
+    return np.where(done, lift, low)
+
+
+def gait_cycle(direction, frames, height=DEFAULT_HEIGHT, stride=40.0, lift=20.0):
+    """Servo poses (frames, 18) of one IK gait cycle for F, B, L or R.
+
+    Each leg lifts as far as its joints allow, up to lift.
+    """
+    lifts = fit_lift(direction, frames, height, stride, lift)
+    return solve(cycle_targets(direction, frames, height, stride, lifts))
+
+
+def benchmark(frames=90, repeats=200):
+    """Average milliseconds to regenerate one gait cycle of frames poses"""
+    gait_cycle('F', frames)
+    started = time.perf_counter()
+    for i in range(repeats):
+        gait_cycle('FBLR'[i % 4], frames, stride=30.0 + i % 20)
+    return (time.perf_counter() - started) * 1000.0 / repeats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time IK gait-cycle generation")
+    parser.add_argument('--frames', type=int, default=90, help="poses per cycle")
+    args = parser.parse_args()
+    print(f"{benchmark(args.frames):.3f} ms per {args.frames}-pose cycle")
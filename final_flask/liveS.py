@@ -1,60 +1,10 @@
-import cv2
 import time
-from threading import Thread, Lock
-from flask import Flask, Response
+from threading import Lock
+from flask import Flask, Response, request
 from flask_basicauth import BasicAuth
-
-# Optimized Webcam class with minimal buffering and latency
-class WebcamVideoStream:
-    def __init__(self, src=0):
-        print("Initializing camera...")
-        self.stream = cv2.VideoCapture(src)
-        
-        # Aggressive camera optimization settings
-        self.stream.set(cv2.CAP_PROP_BUFFERSIZE, 1)      # Minimum buffer size
-        self.stream.set(cv2.CAP_PROP_FRAME_WIDTH, 640)   # Reasonable resolution
-        self.stream.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)  
-        self.stream.set(cv2.CAP_PROP_FPS, 30)            # Target FPS
-        
-        # Try to disable auto focus which can cause periodic delays
-        self.stream.set(cv2.CAP_PROP_AUTOFOCUS, 0)
-        
-        # For some cameras, lower quality can reduce latency
-        self.stream.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
-        
-        self.grabbed, self.frame = self.stream.read()
-        self.stopped = False
-        self.lock = Lock()  # Thread synchronization
-        
-        # Start the thread to read frames
-        Thread(target=self.update, daemon=True).start()
-        
-    def update(self):
-        last_frame_time = time.time()
-        while not self.stopped:
-            # Skip frames if we're running behind (helps reduce latency)
-            current_time = time.time()
-            if current_time - last_frame_time < 0.01:  # Max ~100fps internal processing
-                continue
-                
-            # Get the latest frame and clear the buffer
-            for _ in range(2):  # Try to clear any buffered frames
-                if self.stream.isOpened():
-                    grabbed, frame = self.stream.read()
-                    if grabbed:
-                        with self.lock:
-                            self.grabbed, self.frame = grabbed, frame
-            
-            last_frame_time = current_time
-            
-    def read(self):
-        with self.lock:
-            return self.frame.copy() if self.grabbed else None
-            
-    def stop(self):
-        print("Stopping camera stream...")
-        self.stopped = True
-        self.stream.release()
+from camera import WebcamVideoStream, camera_source
+from encoder import get_shared_encoder, stop_shared_encoder, mjpeg_stream
+from adaptive import is_local_client
 
 app = Flask(__name__)
 
@@ -66,18 +16,22 @@ basic_auth = BasicAuth(app)
 
 # Global camera instance
 camera = None
+camera_lock = Lock()
 
 def get_camera():
     global camera
-    if camera is None or camera.stopped:
-        camera = WebcamVideoStream()
-        time.sleep(0.5)  # Short delay to ensure camera is initialized
+    with camera_lock:
+        if camera is None or camera.stopped:
+            camera = WebcamVideoStream(camera_source(), passthrough=True)
+            time.sleep(0.5)  # Short delay to ensure camera is initialized
     return camera
 
-@app.route('/')
-@basic_auth.required
-def index():
-    return '''
+# Shared encoder feeding every /video_feed viewer
+def get_encoder():
+    return get_shared_encoder(get_camera)
+
+# Dashboard page, served by both the Flask and the asyncio server
+INDEX_HTML = '''
     <html>
     <head>
         <title>Low-Latency Camera Stream</title>
@@ -97,40 +51,27 @@ def index():
     </html>
     '''
 
-def gen():
-    cam = get_camera()
-    jpeg_quality = 70  # Lower quality = faster encoding (adjust as needed)
-    encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
-    
-    while True:
-        frame = cam.read()
-        if frame is None:
-            time.sleep(0.01)  # Short sleep if frame not available
-            continue
-            
-        # Apply a resize to reduce encoding time if needed
-        # frame = cv2.resize(frame, (640, 480))
-            
-        # Encode with optimized parameters
-        ret, jpeg = cv2.imencode('.jpg', frame, encode_params)
-        if not ret:
-            continue
-            
-        # Send frame immediately
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+@app.route('/')
+@basic_auth.required
+def index():
+    return INDEX_HTML
 
 @app.route('/video_feed')
 @basic_auth.required
 def video_feed():
-    return Response(gen(), 
+    adaptive = not is_local_client(request.remote_addr, request.headers.get('X-Forwarded-For'))
+    return Response(mjpeg_stream(get_encoder(), adaptive),
                    mimetype='multipart/x-mixed-replace; boundary=frame')
 
+def cleanup():
+    stop_shared_encoder()
+    if camera is not None:
+        camera.stop()
+
 if __name__ == '__main__':
     # Run with minimal overhead
     app.run(host='0.0.0.0', port=5000, debug=False, threaded=True,
            use_reloader=False)  # Disable reloader for production
            
     # Cleanup
-    if camera is not None:
-        camera.stop()
\ No newline at end of file
+    cleanup()
\ No newline at end of file
@@ -0,0 +1,47 @@
+import time
+import cv2
+import numpy as np
+
+
+# Cheap scene-change detector run before the expensive ones. A small level
+# of the frame's shared grayscale pyramid is compared against a running-average
+# background; the fraction of pixels that differ is the motion energy. The
+# gate opens when the energy passes threshold, and also every max_idle
+# seconds so a face that walked in and stopped is still confirmed.
+class MotionGate:
+    def __init__(self, threshold=0.01, level=3, pixel_threshold=25,
+                 learning_rate=0.1, max_idle=5.0):
+        self.threshold = threshold
+        self.level = level  # Pyramid level compared; 3 is 80x60 for 640x480
+        self.pixel_threshold = pixel_threshold
+        self.learning_rate = learning_rate
+        self.max_idle = max_idle
+
+        self.background = None
+        self.energy = 0.0
+        self.last_open = 0.0
+        self.frames_passed = 0
+        self.frames_gated = 0
+
+    def update(self, products):
+        """Measure motion in a FrameProducts and return True if detectors should run"""
+        gray = products.pyramid(self.level).astype(np.float32)
+        if self.background is None or self.background.shape != gray.shape:
+            self.background = gray
+            self.energy = 1.0
+        else:
+            changed = cv2.absdiff(gray, self.background) > self.pixel_threshold
+            self.energy = float(np.count_nonzero(changed)) / changed.size
+            cv2.accumulateWeighted(gray, self.background, self.learning_rate)
+
+        now = time.time()
+        if self.energy >= self.threshold or now - self.last_open >= self.max_idle:
+            self.last_open = now
+            self.frames_passed += 1
+            return True
+        self.frames_gated += 1
+        return False
+
+    def stats(self):
+        return {'motion_energy': self.energy, 'frames_passed': self.frames_passed,
+                'frames_gated': self.frames_gated}
@@ -0,0 +1,194 @@
+import time
+from collections import namedtuple, deque
+
+# Framed serial protocol shared with Hexapod_final.ino.
+#
+#   SOF  LEN  SEQ  TYPE  PAYLOAD[LEN]  CRC
+#   0xA5  n   0-255 char  n bytes      CRC-8 (poly 0x07) of LEN..PAYLOAD
+#
+# The firmware acts on a frame as soon as its last byte arrives, instead of
+# waiting out Serial.readString()'s timeout, and answers every frame with an
+# ACK or NACK carrying the same sequence number. Bare command letters are
+# still accepted outside a frame, so old senders keep working, but only
+# until the first valid frame: after that, stray bytes are taken to be the
+# remains of a broken frame and ignored.
+SOF = 0xA5
+MAX_PAYLOAD = 32
+OVERHEAD = 5  # SOF, LEN, SEQ, TYPE, CRC
+POSE_SERVOS = 18
+MAX_ANGLE = 180
+
+TYPE_DIRECTION = ord('D')  # payload: one of b'FBLRS'
+TYPE_POSE = ord('P')       # payload: 18 servo angles, 0-180 degrees each
+TYPE_JOINTS = ord('J')     # payload: 3-byte servo mask (LSB first), then the masked angles
+TYPE_ACK = ord('A')        # payload: one status byte
+TYPE_NACK = ord('N')       # frame failed its checksum; no payload
+
+# ACK status codes
+ACK_OK = 0
+ACK_UNKNOWN_TYPE = 1
+ACK_BAD_PAYLOAD = 2
+
+ACK_MESSAGES = {
+    ACK_OK: "Command acknowledged.",
+    ACK_UNKNOWN_TYPE: "Robot rejected the frame type.",
+    ACK_BAD_PAYLOAD: "Robot rejected the command.",
+}
+
+Frame = namedtuple('Frame', ['seq', 'type', 'payload'])
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+    return crc
+
+
+def encode_frame(seq, frame_type, payload=b''):
+    """Return the bytes for one frame"""
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Payload of {len(payload)} bytes exceeds {MAX_PAYLOAD}")
+    body = bytes([len(payload), seq & 0xFF, frame_type]) + bytes(payload)
+    return bytes([SOF]) + body + bytes([crc8(body)])
+
+
+def encode_direction(seq, command):
+    return encode_frame(seq, TYPE_DIRECTION, command.encode())
+
+
+def encode_pose(seq, angles):
+    """Frame setting every servo at once; the firmware's own gait stops"""
+    if len(angles) != POSE_SERVOS or max(angles) > MAX_ANGLE:
+        raise ValueError(f"A pose is {POSE_SERVOS} angles of 0-{MAX_ANGLE} degrees")
+    return encode_frame(seq, TYPE_POSE, bytes(angles))
+
+
+def encode_joints(seq, joints):
+    """Frame setting only some servos; joints maps servo index to angle"""
+    mask = 0
+    for servo in joints:
+        mask |= 1 << servo
+    angles = [joints[servo] for servo in sorted(joints)]
+    return encode_frame(seq, TYPE_JOINTS, mask.to_bytes(3, 'little') + bytes(angles))
+
+
+def decode_joints(frame_type, payload):
+    """(servo, angle) pairs of a pose or joints payload, or None if it is invalid"""
+    if frame_type == TYPE_POSE:
+        if len(payload) != POSE_SERVOS:
+            return None
+        servos, angles = range(POSE_SERVOS), payload
+    else:
+        if len(payload) < 3:
+            return None
+        mask = int.from_bytes(payload[:3], 'little')
+        servos = [i for i in range(POSE_SERVOS) if mask & (1 << i)]
+        angles = payload[3:]
+    if len(servos) != len(angles) or any(angle > MAX_ANGLE for angle in angles):
+        return None
+    return list(zip(servos, angles))
+
+
+# Turns a stream of poses into pose ('P') and joint-delta ('J') frames. A
+# delta carries only the servos that differ from the last pose the robot
+# acknowledged, which is what it is known to hold. A full pose goes out
+# every keyframe_interval frames, after any frame that was not
+# acknowledged, and whenever it would be no bigger than the delta. With
+# delta=False every frame is a full pose, for comparison.
+class PoseEncoder:
+    def __init__(self, delta=True, keyframe_interval=25, history=100):
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.acked = None      # Pose the robot last confirmed
+        self._pending = None
+        self._since_keyframe = 0
+
+        self.frames = 0
+        self.keyframes = 0
+        self.bytes_sent = 0
+        self.failures = 0
+        self._acked_times = deque(maxlen=history)
+
+    def encode(self, seq, pose):
+        """Return the frame bytes that take the robot to pose"""
+        pose = bytes(pose)
+        changed = None
+        if self.delta and self.acked is not None and self._since_keyframe < self.keyframe_interval:
+            changed = {i: angle for i, angle in enumerate(pose) if angle != self.acked[i]}
+            if 3 + len(changed) >= POSE_SERVOS:
+                changed = None
+        if changed is None:
+            frame = encode_pose(seq, pose)
+            self.keyframes += 1
+            self._since_keyframe = 0
+        else:
+            frame = encode_joints(seq, changed)
+            self._since_keyframe += 1
+        self._pending = pose
+        self.frames += 1
+        self.bytes_sent += len(frame)
+        return frame
+
+    def confirm(self):
+        """The last encoded frame was acknowledged"""
+        self.acked = self._pending
+        self._acked_times.append(time.time())
+
+    def fail(self):
+        """The last encoded frame may not have arrived; resync with a full pose"""
+        self.reset()
+        self.failures += 1
+
+    def reset(self):
+        """Forget the robot's pose, e.g. once its own gait has moved the servos"""
+        self.acked = None
+
+    def stats(self):
+        times = self._acked_times
+        rate = (len(times) - 1) / (times[-1] - times[0]) if len(times) > 1 and times[-1] > times[0] else 0.0
+        return {'mode': 'delta' if self.delta else 'full', 'frames': self.frames,
+                'keyframes': self.keyframes, 'failures': self.failures,
+                'bytes_per_frame': self.bytes_sent / float(self.frames) if self.frames else 0.0,
+                'frames_per_second': rate}
+
+
+# Incremental decoder for the byte stream coming back from the robot. Bytes
+# outside frames (debug prints, line noise) are skipped; a frame with a bad
+# checksum is dropped and the decoder resynchronises on the next SOF.
+class FrameDecoder:
+    def __init__(self):
+        self._buf = bytearray()
+        self.frames_decoded = 0
+        self.crc_errors = 0
+
+    def feed(self, data):
+        """Add received bytes and return the list of complete frames"""
+        self._buf.extend(data)
+        frames = []
+        while True:
+            start = self._buf.find(SOF)
+            if start < 0:
+                self._buf.clear()
+                break
+            del self._buf[:start]
+            if len(self._buf) < 2:
+                break
+            length = self._buf[1]
+            if length > MAX_PAYLOAD:
+                del self._buf[0]  # Not a real SOF
+                continue
+            total = length + OVERHEAD
+            if len(self._buf) < total:
+                break
+            body = bytes(self._buf[1:total - 1])
+            if crc8(body) != self._buf[total - 1]:
+                self.crc_errors += 1
+                del self._buf[0]
+                continue
+            frames.append(Frame(body[1], body[2], body[3:]))
+            self.frames_decoded += 1
+            del self._buf[:total]
+        return frames
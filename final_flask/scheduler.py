@@ -0,0 +1,118 @@
+import time
+import heapq
+import itertools
+from collections import OrderedDict
+from threading import Thread, Condition
+
+
+# A "move X for N seconds" request: its direction starts at once and a stop
+# is due at ends, unless a newer command gets there first
+class TimedMotion:
+    def __init__(self, motion_id, command, duration, clock=time):
+        self.id = motion_id
+        self.command = command
+        self.duration = duration
+        self.clock = clock
+        self.started = clock.time()
+        self.ends = self.started + duration
+        self.state = 'running'
+        self.command_id = None  # Serial worker id of the direction command
+        self.stop_command_id = None
+
+    def status(self):
+        status = {'id': self.id, 'command': self.command, 'duration': self.duration,
+                  'state': self.state, 'command_id': self.command_id}
+        if self.state == 'running':
+            status['remaining'] = max(0.0, self.ends - self.clock.time())
+        if self.stop_command_id is not None:
+            status['stop_command_id'] = self.stop_command_id
+        return status
+
+
+# Runs timed motions in the background with a deadline heap, so handlers
+# return immediately. Only one motion is active at a time: any newer command
+# pre-empts it and its pending stop is dropped instead of firing late.
+class MotionScheduler:
+    def __init__(self, serial_worker, history=256, clock=time):
+        self.serial_worker = serial_worker
+        self.history = history
+        # time() source; a simulator.SimClock runs faster than real time, so
+        # waits are shortened by its scale
+        self.clock = clock
+        self.time_scale = getattr(clock, 'scale', 1.0)
+        self.stopped = False
+        self.active = None
+
+        self._cond = Condition()
+        self._heap = []  # (deadline, motion id); stale entries are skipped
+        self._motions = OrderedDict()
+        self._ids = itertools.count(1)
+
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+
+    def send(self, command):
+        """Send an untimed command, pre-empting any running timed motion"""
+        with self._cond:
+            self._finish_active('preempted')
+            return self.serial_worker.submit(command)
+
+    def start(self, command, duration):
+        """Start command now and schedule a stop after duration seconds"""
+        with self._cond:
+            self._finish_active('preempted')
+            motion = TimedMotion(next(self._ids), command, duration, self.clock)
+            motion.command_id = self.serial_worker.submit(command).id
+            self.active = motion
+            self._motions[motion.id] = motion
+            while len(self._motions) > self.history:
+                self._motions.popitem(last=False)
+            heapq.heappush(self._heap, (motion.ends, motion.id))
+            self._cond.notify()
+            return motion
+
+    def cancel(self, motion_id):
+        """Stop a running motion early; returns its status or None"""
+        with self._cond:
+            motion = self._motions.get(motion_id)
+            if motion is None:
+                return None
+            if motion is self.active:
+                motion.stop_command_id = self.serial_worker.submit('S').id
+                self._finish_active('cancelled')
+            return motion.status()
+
+    def status(self, motion_id):
+        with self._cond:
+            motion = self._motions.get(motion_id)
+            return motion.status() if motion is not None else None
+
+    def _finish_active(self, state):
+        # Caller holds self._cond
+        if self.active is not None:
+            self.active.state = state
+            self.active = None
+
+    def update(self):
+        with self._cond:
+            while not self.stopped:
+                # Drop heap entries for motions that were pre-empted or cancelled
+                while self._heap and (self.active is None or self._heap[0][1] != self.active.id):
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - self.clock.time()
+                if delay > 0:
+                    self._cond.wait(timeout=delay / self.time_scale)
+                    continue
+                heapq.heappop(self._heap)
+                self.active.stop_command_id = self.serial_worker.submit('S').id
+                self._finish_active('completed')
+
+    def stop(self):
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
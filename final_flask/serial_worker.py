@@ -0,0 +1,211 @@
+import time
+import itertools
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from threading import Thread, Condition
+import protocol
+
+# Single-letter commands that only change the robot's walking direction; a
+# newer one makes any still-queued older one pointless
+DIRECTION_COMMANDS = {'F', 'B', 'L', 'R', 'S'}
+# Command name of pose frames queued by submit_pose()
+POSE_COMMAND = 'P'
+
+
+# One queued write to the Arduino and the future its response resolves
+class SerialCommand:
+    def __init__(self, command_id, command, payload=None):
+        self.id = command_id
+        self.command = command
+        self.payload = payload  # Servo angles of a pose frame
+        self.future = Future()
+        self.state = 'queued'
+        self.submitted = time.time()
+        self.sent = None
+        self.acked = None
+
+    def status(self):
+        status = {'id': self.id, 'command': self.command, 'state': self.state}
+        if self.future.done():
+            status['response'] = self.future.result()
+        if self.sent is not None:
+            status['queue_delay'] = self.sent - self.submitted
+        if self.acked is not None:
+            status['ack_latency'] = self.acked - self.sent
+        return status
+
+
+# Owns the serial port: every write and read happens on this one thread, so
+# concurrent HTTP requests can no longer interleave writes or steal each
+# other's responses. Handlers submit() and return straight away.
+class SerialWorker:
+    def __init__(self, ser, response_window=0.1, history=256, framed=True,
+                 ack_timeout=0.05, retries=2, delta_poses=True):
+        self.ser = ser
+        self.response_window = response_window  # How long to collect a reply
+        self.history = history
+
+        # Framed mode speaks protocol.py and waits for the matching ACK;
+        # otherwise bare command letters are written as before
+        self.framed = framed
+        self.ack_timeout = ack_timeout
+        self.retries = retries
+        self.decoder = protocol.FrameDecoder()
+        self.retransmits = 0
+        # Poses go out as joint deltas against the last acknowledged pose
+        self.pose_encoder = protocol.PoseEncoder(delta=delta_poses)
+        self._seq = 0
+        self.stopped = False
+        self.commands_sent = 0
+        self.commands_coalesced = 0
+
+        self._cond = Condition()
+        self._queue = deque()
+        self._commands = OrderedDict()  # Recent commands by id, for status()
+        self._ids = itertools.count(1)
+
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+
+    def submit(self, command):
+        """Queue a command and return its SerialCommand without blocking"""
+        with self._cond:
+            entry = SerialCommand(next(self._ids), command)
+            if command in DIRECTION_COMMANDS:
+                # Drop queued direction changes and poses this one overrides
+                self._supersede(entry, DIRECTION_COMMANDS | {POSE_COMMAND})
+            return self._enqueue(entry)
+
+    def submit_pose(self, angles):
+        """Queue a pose frame (18 servo angles) and return its SerialCommand.
+
+        Only the newest pose matters, so one still queued is replaced rather
+        than sent late. Needs the framed protocol.
+        """
+        with self._cond:
+            entry = SerialCommand(next(self._ids), POSE_COMMAND, bytes(angles))
+            self._supersede(entry, {POSE_COMMAND})
+            return self._enqueue(entry)
+
+    def _supersede(self, entry, commands):
+        for pending in [p for p in self._queue if p.command in commands]:
+            self._queue.remove(pending)
+            pending.state = 'superseded'
+            pending.future.set_result(f"Superseded by command {entry.id}.")
+            self.commands_coalesced += 1
+
+    def _enqueue(self, entry):
+        # Called with self._cond held
+        self._queue.append(entry)
+        self._commands[entry.id] = entry
+        while len(self._commands) > self.history:
+            self._commands.popitem(last=False)
+        self._cond.notify()
+        return entry
+
+    def status(self, command_id):
+        """Return the status dict for a recent command, or None"""
+        with self._cond:
+            entry = self._commands.get(command_id)
+            return entry.status() if entry is not None else None
+
+    def update(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self.stopped)
+                if self.stopped:
+                    break
+                entry = self._queue.popleft()
+                entry.state = 'sending'
+            try:
+                response = self._transact(entry)
+            except Exception as e:
+                print(f"Serial error: {e}")
+                response = f"Serial error: {e}"
+            entry.state = 'done'
+            entry.future.set_result(response)
+
+        # Fail anything still queued so no caller waits forever
+        with self._cond:
+            while self._queue:
+                entry = self._queue.popleft()
+                entry.state = 'cancelled'
+                entry.future.set_result("Serial worker stopped.")
+
+    def _transact(self, entry):
+        if self.framed:
+            return self._transact_framed(entry)
+        if entry.payload is not None:
+            return "Pose frames need the framed protocol."
+
+        # Discard chatter from the firmware's step loop so the reply we read
+        # really belongs to this command
+        self.ser.reset_input_buffer()
+        self.ser.write(entry.command.encode())
+        self.commands_sent += 1
+        entry.sent = time.time()
+
+        deadline = entry.sent + self.response_window
+        while time.time() < deadline:
+            if self.ser.in_waiting > 0:
+                return self.ser.readline().decode(errors='replace').strip()
+            time.sleep(0.005)
+        return "Command sent."
+
+    def _transact_framed(self, entry):
+        self._seq = (self._seq + 1) & 0xFF
+        seq = self._seq
+        pose = entry.payload is not None
+        if pose:
+            frame = self.pose_encoder.encode(seq, entry.payload)
+            retries = 0  # The next pose is already on its way
+        else:
+            frame = protocol.encode_direction(seq, entry.command)
+            retries = self.retries
+            # The firmware's gaits move the servos from here on
+            self.pose_encoder.reset()
+        for attempt in range(1 + retries):
+            if attempt:
+                self.retransmits += 1
+            self.ser.write(frame)
+            if entry.sent is None:
+                self.commands_sent += 1
+                entry.sent = time.time()
+            reply = self._wait_reply(seq, time.time() + self.ack_timeout)
+            if reply is None or reply.type == protocol.TYPE_NACK:
+                continue  # Lost or corrupted on the way; send it again
+            entry.acked = time.time()
+            status = reply.payload[0] if reply.payload else protocol.ACK_OK
+            if pose:
+                if status == protocol.ACK_OK:
+                    self.pose_encoder.confirm()
+                else:
+                    self.pose_encoder.fail()
+            return protocol.ACK_MESSAGES.get(status, f"Robot replied with status {status}.")
+        if pose:
+            self.pose_encoder.fail()
+        return "No acknowledgement from robot."
+
+    def pose_stats(self):
+        """Achieved pose frame rate and bytes per frame"""
+        return self.pose_encoder.stats()
+
+    def _wait_reply(self, seq, deadline):
+        # Read until the ACK/NACK for seq arrives; replies to earlier,
+        # already retried frames are discarded
+        while True:
+            waiting = self.ser.in_waiting
+            if waiting:
+                for frame in self.decoder.feed(self.ser.read(waiting)):
+                    if frame.seq == seq and frame.type in (protocol.TYPE_ACK, protocol.TYPE_NACK):
+                        return frame
+            if time.time() >= deadline:
+                return None
+            time.sleep(0.001)
+
+    def stop(self):
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
@@ -0,0 +1,204 @@
+import time
+from multiprocessing import shared_memory, resource_tracker
+import cv2
+import numpy as np
+
+DEFAULT_NAME = 'hexapod_frames'
+MAGIC = 0x48455841  # 'HEXA'
+SLOTS = 4
+
+KIND_RAW = 0   # BGR pixels
+KIND_JPEG = 1  # Compressed bytes straight from the camera
+
+# Segment layout: a header, per-slot metadata, per-slot timestamps, then the
+# slot data. Each slot works as a seqlock: the writer zeroes its seq, fills
+# it, then stores the new seq, and a reader only trusts a copy if the slot's
+# seq is the same before and after copying.
+_HEADER = 4  # magic, latest seq, slots, slot bytes (uint64)
+_META = 6    # seq, length, kind, height, width, channels (uint64 per slot)
+
+
+def _layout(buf, slots):
+    header = np.ndarray((_HEADER,), np.uint64, buffer=buf)
+    offset = header.nbytes
+    meta = np.ndarray((slots, _META), np.uint64, buffer=buf, offset=offset)
+    offset += meta.nbytes
+    stamps = np.ndarray((slots,), np.float64, buffer=buf, offset=offset)
+    offset += stamps.nbytes
+    return header, meta, stamps, offset
+
+
+def _attach(name):
+    # Consumers must not unlink the segment when they exit, which the
+    # resource tracker would otherwise do for them
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+# Writer side, owned by camera_service.py: the only process that opens the
+# camera publishes every frame here for any number of local consumers
+class SharedFrameWriter:
+    def __init__(self, name=DEFAULT_NAME, slot_bytes=640 * 480 * 3, slots=SLOTS):
+        header_bytes = (_HEADER + slots * _META) * 8 + slots * 8
+        try:
+            # A segment left behind by a crashed service
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+        except FileNotFoundError:
+            pass
+        self.block = shared_memory.SharedMemory(name=name, create=True,
+                                                size=header_bytes + slots * slot_bytes)
+        self.name = name
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.header, self.meta, self.stamps, offset = _layout(self.block.buf, slots)
+        self.data = np.ndarray((slots, slot_bytes), np.uint8, buffer=self.block.buf, offset=offset)
+        self.header[:] = (MAGIC, 0, slots, slot_bytes)
+        self.meta[:] = 0
+        self.frames_dropped = 0  # Frames too large for a slot
+
+    def publish(self, frame, kind, shape=(0, 0, 0), timestamp=None):
+        """Copy one frame (a uint8 array) into the next slot; returns its seq"""
+        flat = frame.reshape(-1)
+        if flat.size > self.slot_bytes:
+            self.frames_dropped += 1
+            return None
+        seq = int(self.header[1]) + 1
+        slot = seq % self.slots
+        self.meta[slot, 0] = 0  # Readers skip the slot while it is written
+        self.data[slot, :flat.size] = flat
+        self.stamps[slot] = time.time() if timestamp is None else timestamp
+        self.meta[slot, 1:] = (flat.size, kind) + tuple(shape)
+        self.meta[slot, 0] = seq
+        self.header[1] = seq
+        return seq
+
+    def close(self):
+        del self.header, self.meta, self.stamps, self.data
+        self.block.close()
+        self.block.unlink()
+
+
+# Reader side, shaped like cv2.VideoCapture so WebcamVideoStream can use it
+# as its source unchanged. Consumers attach and detach freely; the camera
+# itself stays open in the service. Waits poll the segment's sequence number
+# every poll_interval, since there is no cross-process condition variable.
+class SharedFrameCapture:
+    def __init__(self, name=DEFAULT_NAME, poll_interval=0.002, timeout=2.0):
+        self.name = name
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.convert_rgb = True
+        self.last_seq = 0
+        self.frames_torn = 0  # Reads retried because the writer lapped them
+        self.block = None
+        self.opened = True
+        self._attach()
+
+    def _attach(self):
+        self._detach()
+        try:
+            self.block = _attach(self.name)
+        except FileNotFoundError:
+            return False
+        self.header = np.ndarray((_HEADER,), np.uint64, buffer=self.block.buf)
+        if int(self.header[0]) != MAGIC:
+            self._detach()
+            return False
+        slots, slot_bytes = int(self.header[2]), int(self.header[3])
+        self.header, self.meta, self.stamps, offset = _layout(self.block.buf, slots)
+        self.data = np.ndarray((slots, slot_bytes), np.uint8, buffer=self.block.buf, offset=offset)
+        self.last_seq = 0
+        return True
+
+    def _detach(self):
+        if self.block is not None:
+            del self.header, self.meta, self.stamps, self.data
+            self.block.close()
+            self.block = None
+
+    def _next(self, out=None):
+        # Wait for a frame newer than the last one read and copy it out, into
+        # out if it is a raw frame of out's size
+        deadline = time.time() + self.timeout
+        while self.opened:
+            if self.block is None:
+                if not self._attach():
+                    if time.time() > deadline:
+                        return None
+                    time.sleep(0.1)
+                    continue
+            seq = int(self.header[1])
+            if seq > self.last_seq:
+                slot = seq % len(self.meta)
+                meta = self.meta[slot].copy()
+                if int(meta[0]) == seq:
+                    length, kind, h, w, c = [int(v) for v in meta[1:]]
+                    if out is not None and kind == KIND_RAW and out.size == length:
+                        np.copyto(out.reshape(-1), self.data[slot, :length])
+                        data = out
+                    else:
+                        data = self.data[slot, :length].copy()
+                    if int(self.meta[slot, 0]) == seq:
+                        self.last_seq = seq
+                        return kind, (h, w, c), data, float(self.stamps[slot])
+                self.frames_torn += 1
+                continue
+            if time.time() > deadline:
+                # The service may have restarted with a new segment
+                self._attach()
+                deadline = time.time() + self.timeout
+                if self.block is None:
+                    return None
+            time.sleep(self.poll_interval)
+        return None
+
+    # cv2.VideoCapture interface
+
+    def read(self, image=None):
+        frame = self._next(image if self.convert_rgb else None)
+        if frame is None:
+            return False, None
+        kind, shape, data, _ = frame
+        if data is image:
+            return True, image
+        if kind == KIND_JPEG:
+            if not self.convert_rgb:
+                return True, data.reshape(1, -1)
+            pixels = cv2.imdecode(data, cv2.IMREAD_COLOR)
+        else:
+            pixels = data.reshape(shape)
+            if not self.convert_rgb:
+                return True, pixels
+        if image is not None and image.shape == pixels.shape:
+            np.copyto(image, pixels)
+            return True, image
+        return True, pixels
+
+    def grab(self):
+        return self._next() is not None
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_CONVERT_RGB:
+            self.convert_rgb = bool(value)
+            return True
+        return False  # Capture settings belong to the service
+
+    def get(self, prop):
+        if self.block is not None and self.last_seq and prop in (cv2.CAP_PROP_FRAME_WIDTH,
+                                                                 cv2.CAP_PROP_FRAME_HEIGHT):
+            meta = self.meta[self.last_seq % len(self.meta)]
+            return float(meta[4] if prop == cv2.CAP_PROP_FRAME_WIDTH else meta[3])
+        return 0.0
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+        self._detach()
@@ -0,0 +1,461 @@
+import csv
+import time
+import argparse
+from threading import Lock
+import numpy as np
+import protocol
+from firmware_model import (GAIT_STEPS, INITIAL_ANGLES, DEFAULT_SPEED, DIRECTION_NAMES,
+                            tripod_b_lifted)
+
+SERVO_SPEED = 350.0   # deg/s; an MG996R under load turns 60 degrees in about 0.17 s
+FRAME_TIMEOUT = 0.05  # Same as FRAME_TIMEOUT_MS in the firmware
+
+
+# Clock with the time module's time()/monotonic()/sleep() that runs scale
+# times faster than real time, for running the control stack accelerated
+class SimClock:
+    def __init__(self, scale=1.0):
+        self.scale = scale
+        self._real_start = time.perf_counter()
+
+    def time(self):
+        return (time.perf_counter() - self._real_start) * self.scale
+
+    monotonic = time
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.scale)
+
+
+# One command the simulated robot received, with its timeline in simulated
+# seconds: sent (first byte on the wire), received (last byte in), acked
+# (ACK back at the host) and acted (first servo write it caused)
+class CommandRecord:
+    FIELDS = ('index', 'kind', 'command', 'sent', 'received', 'acked', 'acted', 'state')
+
+    def __init__(self, index, kind, command, sent, received):
+        self.index = index
+        self.kind = kind          # legacy, direction, pose or joints
+        self.command = command
+        self.sent = sent
+        self.received = received
+        self.acked = None
+        self.acted = None
+        self.state = 'pending'    # acted, superseded or rejected
+
+    def latency(self):
+        return self.acted - self.sent if self.acted is not None else None
+
+    def row(self):
+        return [getattr(self, field) for field in self.FIELDS]
+
+
+# Headless model of Hexapod_final.ino on simulated time. It takes the same
+# byte stream as the serial link (bare letters, direction, pose and joint
+# frames), charges wire time at baud for every byte, and replays the
+# firmware's loop as events: a gait cycle writes its steps delay(speed)
+# apart, a repeat of the current direction waits for the running cycle to
+# finish, and a new direction or a pose frame takes over at once (a stop,
+# or a change with tripod B lifted, first settles every leg for one step).
+# Servos turn towards their last written angle at servo_speed, and both
+# commanded and actual angles are sampled every sample_interval for export.
+# Nothing waits on the wall clock, so a scripted run goes as fast as the CPU
+# allows.
+class HexapodSimulator:
+    def __init__(self, speed=DEFAULT_SPEED, baud=115200, servo_speed=SERVO_SPEED,
+                 sample_interval=0.01):
+        self.speed = speed
+        self.baud = baud
+        self.servo_speed = servo_speed
+        self.sample_interval = sample_interval
+        self.lock = Lock()
+
+        self.now = 0.0
+        self.direction = 'a'
+        self.streaming = False
+        self.commanded = np.array(INITIAL_ANGLES, np.float32)
+        self.actual = self.commanded.copy()
+
+        self._cycle = None         # Direction of the gait cycle in progress; None while settling
+        self._step = 0             # Next step of that cycle
+        self._step_due = None      # When it is due; None when idle
+        self._waiting = []         # Direction commands the gait has not acted on yet
+
+        self._rx_free = 0.0        # When the link to the robot is next idle
+        self._tx_free = 0.0        # When the link back to the host is next idle
+        self._in_frame = False
+        self._framed_link = False  # A valid frame has arrived; bare letters are ignored
+        self._frame = bytearray()
+        self._frame_start = 0.0
+        self._frame_sent = 0.0
+        self._replies = []         # (arrival time, bytes) on their way to the host
+
+        self.commands = []
+        self.cycles = 0
+        self.crc_errors = 0
+        self._times = []
+        self._commanded = []
+        self._actual = []
+        self._next_sample = 0.0
+
+    # Link
+
+    def receive(self, data, t):
+        """Bytes written by the host at simulated time t"""
+        with self.lock:
+            start = max(t, self._rx_free)
+            for i, b in enumerate(data):
+                arrival = start + (i + 1) * 10.0 / self.baud  # 8N1: ten bits per byte
+                self._advance(arrival)
+                self._feed(b, arrival, start)
+            self._rx_free = start + len(data) * 10.0 / self.baud
+
+    def replies(self, t):
+        """Bytes the robot has sent back that reached the host by simulated time t"""
+        with self.lock:
+            self._advance(t)
+            ready = [data for arrival, data in self._replies if arrival <= t]
+            self._replies = [reply for reply in self._replies if reply[0] > t]
+            return b''.join(ready)
+
+    def advance(self, t):
+        """Run the robot up to simulated time t"""
+        with self.lock:
+            self._advance(t)
+
+    def _send(self, data, t):
+        start = max(t, self._tx_free)
+        self._tx_free = start + len(data) * 10.0 / self.baud
+        self._replies.append((self._tx_free, data))
+        return self._tx_free
+
+    # pollSerial()
+
+    def _feed(self, b, t, sent):
+        if self._in_frame and t - self._frame_start > FRAME_TIMEOUT:
+            self._in_frame = False
+        if not self._in_frame:
+            if b == protocol.SOF:
+                self._in_frame = True
+                self._frame.clear()
+                self._frame_start = t
+                self._frame_sent = sent
+            elif not self._framed_link and chr(b) in 'FBLRS':
+                record = self._record('legacy', chr(b), sent, t)
+                self._set_direction(chr(b), record, t)
+            return
+
+        self._frame.append(b)
+        if self._frame[0] > protocol.MAX_PAYLOAD:
+            self._in_frame = False
+            return
+        if len(self._frame) == self._frame[0] + 4:
+            self._in_frame = False
+            body = bytes(self._frame[:-1])
+            if protocol.crc8(body) != self._frame[-1]:
+                self.crc_errors += 1
+                self._send(protocol.encode_frame(body[1], protocol.TYPE_NACK), t)
+                return
+            self._framed_link = True
+            self._handle_frame(body[1], body[2], body[3:], self._frame_sent, t)
+
+    def _handle_frame(self, seq, frame_type, payload, sent, t):
+        status = protocol.ACK_BAD_PAYLOAD
+        if frame_type == protocol.TYPE_DIRECTION:
+            command = chr(payload[0]) if len(payload) == 1 else '?'
+            record = self._record('direction', command, sent, t)
+            if self._set_direction(command, record, t):
+                status = protocol.ACK_OK
+        elif frame_type in (protocol.TYPE_POSE, protocol.TYPE_JOINTS):
+            joints = protocol.decode_joints(frame_type, payload)
+            kind = 'pose' if frame_type == protocol.TYPE_POSE else 'joints'
+            command = ' '.join(f"{servo}:{angle}" for servo, angle in joints or [])
+            record = self._record(kind, command, sent, t)
+            if joints is not None:
+                self.streaming = True
+                self.direction = 'S'
+                self._step_due = None  # stepDelay() gives up on the running cycle
+                self._supersede()
+                for servo, angle in joints:
+                    self.commanded[servo] = angle
+                record.acted, record.state = t, 'acted'
+                status = protocol.ACK_OK
+            else:
+                record.state = 'rejected'
+        else:
+            status = protocol.ACK_UNKNOWN_TYPE
+            record = self._record('unknown', chr(frame_type), sent, t)
+            record.state = 'rejected'
+        record.acked = self._send(protocol.encode_frame(seq, protocol.TYPE_ACK, bytes([status])), t)
+
+    def _set_direction(self, command, record, t):
+        self.streaming = False
+        changed = command != self.direction
+        valid = command in DIRECTION_NAMES or command == 'S'
+        self.direction = command if valid else 'S'
+        if not valid:
+            record.state = 'rejected'
+        self._supersede()
+        self._waiting.append(record)
+        if self._step_due is not None and self._cycle is None:
+            pass  # settle() finishes its wait before loop() looks again
+        elif (self._step_due is not None and changed
+              and (self.direction == 'S' or tripod_b_lifted(self.commanded))):
+            # stepDelay() puts every leg down before stopping, or before a
+            # new gait lifts tripod A while tripod B is still up
+            self.commanded[:] = INITIAL_ANGLES
+            if record.state == 'pending':
+                record.acted, record.state = t, 'acted'
+            self._waiting = []
+            self._cycle = None
+            self._step_due = t + self.speed / 1000.0
+        elif self._step_due is None or changed:
+            # loop() was idle, or stepDelay() gives up on the running cycle
+            # for the new direction, so it takes effect straight away
+            self._start_cycle(t)
+        return valid
+
+    def _supersede(self):
+        for record in self._waiting:
+            if record.state == 'pending':
+                record.state = 'superseded'
+        self._waiting = []
+
+    def _record(self, kind, command, sent, received):
+        record = CommandRecord(len(self.commands), kind, command, sent, received)
+        self.commands.append(record)
+        return record
+
+    # loop() and the gait functions
+
+    def _start_cycle(self, t):
+        # A new cycle begins: the firmware is now acting on the latest direction
+        for record in self._waiting:
+            if record.state == 'pending':
+                record.acted, record.state = t, 'acted'
+        self._waiting = []
+        if self.direction in GAIT_STEPS and not self.streaming:
+            self._cycle = self.direction
+            self._step = 0
+            self._step_due = t
+            self._run_steps(t)
+        else:
+            self._cycle = None
+            self._step_due = None
+
+    def _run_steps(self, t):
+        # Write steps until one is followed by delay(speed), or the cycle ends
+        steps = GAIT_STEPS[self._cycle]
+        while self._step < len(steps):
+            step = steps[self._step]
+            self._step += 1
+            for servo, angle in step.writes:
+                self.commanded[servo] = angle
+            if step.delay:
+                self._step_due = t + self.speed / 1000.0
+                return
+        self.cycles += 1
+        self._start_cycle(t)
+
+    def _advance(self, t):
+        while self._step_due is not None and self._step_due <= t:
+            due = self._step_due
+            self._sample(due)
+            if self._cycle is None:
+                self._start_cycle(due)  # Settled; loop() runs the latest direction
+            else:
+                self._run_steps(due)
+        self._sample(t)
+
+    # Servo motion and traces
+
+    def _sample(self, t):
+        while self._next_sample <= t:
+            self._move(self._next_sample)
+            self._times.append(self._next_sample)
+            self._commanded.append(self.commanded.copy())
+            self._actual.append(self.actual.copy())
+            self._next_sample += self.sample_interval
+        self._move(t)
+
+    def _move(self, t):
+        # Every servo turns towards its written angle at servo_speed
+        if t > self.now:
+            reach = self.servo_speed * (t - self.now)
+            self.actual += np.clip(self.commanded - self.actual, -reach, reach)
+            self.now = t
+
+    def traces(self):
+        """Sampled joint angles: time (n,), commanded and actual (n, 18), in degrees"""
+        with self.lock:
+            return {'time': np.array(self._times),
+                    'commanded': np.array(self._commanded).reshape(-1, protocol.POSE_SERVOS),
+                    'actual': np.array(self._actual).reshape(-1, protocol.POSE_SERVOS)}
+
+    def latencies(self):
+        """Per-command latency, first byte sent to first servo write, of the commands acted on"""
+        return np.array([record.latency() for record in self.commands if record.acted is not None])
+
+    def save_npz(self, path):
+        """Write the traces, plus one command_<field> array per CommandRecord field"""
+        traces = self.traces()
+        with self.lock:
+            records = list(self.commands)
+        columns = {}
+        for field in CommandRecord.FIELDS:
+            values = [getattr(record, field) for record in records]
+            if field in ('sent', 'received', 'acked', 'acted'):
+                values = [np.nan if value is None else value for value in values]
+            columns[f"command_{field}"] = np.array(values)
+        np.savez(path, **traces, **columns)
+
+    def save_csv(self, prefix):
+        """Write <prefix>_joints.csv and <prefix>_commands.csv"""
+        traces = self.traces()
+        with open(f"{prefix}_joints.csv", 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time'] + [f"cmd_{i}" for i in range(protocol.POSE_SERVOS)]
+                            + [f"act_{i}" for i in range(protocol.POSE_SERVOS)])
+            for t, commanded, actual in zip(traces['time'], traces['commanded'], traces['actual']):
+                writer.writerow([f"{t:.4f}"] + [f"{a:.1f}" for a in commanded]
+                                + [f"{a:.1f}" for a in actual])
+        with open(f"{prefix}_commands.csv", 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CommandRecord.FIELDS + ('latency',))
+            for record in self.commands:
+                writer.writerow(record.row() + [record.latency()])
+
+    def summary(self):
+        latencies = self.latencies()
+        summary = {'simulated_seconds': self.now, 'commands': len(self.commands),
+                   'cycles': self.cycles, 'crc_errors': self.crc_errors}
+        if len(latencies):
+            summary['latency_p50'] = float(np.percentile(latencies, 50))
+            summary['latency_p95'] = float(np.percentile(latencies, 95))
+            summary['latency_max'] = float(latencies.max())
+        return summary
+
+
+# The host's end of a link to a HexapodSimulator, with the parts of
+# pyserial's Serial that SerialWorker uses, so the real control stack can
+# drive the simulated robot. Time comes from clock (a SimClock).
+class SimulatedSerial:
+    def __init__(self, simulator, clock=None):
+        self.simulator = simulator
+        self.clock = clock or SimClock()
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self.simulator.receive(bytes(data), self.clock.time())
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        self._buffer.extend(self.simulator.replies(self.clock.time()))
+        return len(self._buffer)
+
+    def read(self, size=1):
+        self.in_waiting
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self):
+        self.in_waiting
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        return self.read(end)
+
+    def reset_input_buffer(self):
+        self.in_waiting
+        self._buffer.clear()
+
+    def close(self):
+        pass
+
+
+def run_script(script, duration, framed=True, **options):
+    """Replay [(time, command), ...] of direction letters on a new simulator.
+
+    Runs in simulated time only, as fast as the CPU allows, and returns the
+    simulator for its traces and command records.
+    """
+    simulator = HexapodSimulator(**options)
+    for seq, (t, command) in enumerate(sorted(script)):
+        data = protocol.encode_direction(seq + 1, command) if framed else command.encode()
+        simulator.receive(data, t)
+    simulator.advance(duration)
+    return simulator
+
+
+def run_stack(script, duration, scale=10.0, gait=None):
+    """Drive the simulator through SerialWorker, MotionScheduler and optionally
+    a GaitEngine ('host' or 'ik'), with simulated time running scale times
+    faster than real time. script is [(time, command, seconds)], seconds 0 for
+    an untimed command."""
+    from serial_worker import SerialWorker
+    from scheduler import MotionScheduler
+
+    simulator = HexapodSimulator()
+    clock = SimClock(scale)
+    worker = SerialWorker(SimulatedSerial(simulator, clock))
+    engine = None
+    if gait:
+        from gait import GaitEngine
+        engine = GaitEngine(worker, ik=gait == 'ik', clock=clock)
+    scheduler = MotionScheduler(engine or worker, clock=clock)
+    for t, command, seconds in sorted(script):
+        clock.sleep(t - clock.time())
+        if seconds:
+            scheduler.start(command, seconds)
+        else:
+            scheduler.send(command)
+    clock.sleep(duration - clock.time())
+    scheduler.stop()
+    if engine is not None:
+        engine.stop()
+    worker.stop()
+    simulator.advance(duration)
+    return simulator
+
+
+def _parse_script(items):
+    # "F@0" sends F at 0 s; "L@2:3" turns left at 2 s for 3 s
+    script = []
+    for item in items:
+        command, _, when = item.partition('@')
+        when, _, seconds = when.partition(':')
+        script.append((float(when or 0), command.upper(), float(seconds or 0)))
+    return script
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless Hexapod_final simulator")
+    parser.add_argument('commands', nargs='*', default=['F@0', 'L@4', 'S@8'],
+                        help="COMMAND@SECONDS, or COMMAND@SECONDS:DURATION with --stack")
+    parser.add_argument('--duration', type=float, default=10.0, help="simulated seconds")
+    parser.add_argument('--stack', action='store_true',
+                        help="drive it through SerialWorker and MotionScheduler")
+    parser.add_argument('--scale', type=float, default=10.0,
+                        help="with --stack, simulated seconds per real second")
+    parser.add_argument('--gait', choices=['host', 'ik'], help="with --stack, stream poses")
+    parser.add_argument('--legacy', action='store_true', help="send bare letters, not frames")
+    parser.add_argument('--csv', metavar='PREFIX', help="write PREFIX_joints.csv and PREFIX_commands.csv")
+    parser.add_argument('--npz', metavar='PATH', help="write traces and commands to PATH")
+    args = parser.parse_args()
+
+    script = _parse_script(args.commands)
+    started = time.time()
+    if args.stack:
+        simulator = run_stack(script, args.duration, args.scale, args.gait)
+    else:
+        simulator = run_script([(t, command) for t, command, _ in script], args.duration,
+                               framed=not args.legacy)
+    elapsed = time.time() - started
+    for key, value in simulator.summary().items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+    print(f"{args.duration / elapsed:.1f}x real time")
+    if args.csv:
+        simulator.save_csv(args.csv)
+    if args.npz:
+        simulator.save_npz(args.npz)
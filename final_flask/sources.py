@@ -0,0 +1,224 @@
+import os
+import time
+import argparse
+import cv2
+import numpy as np
+
+
+# Frame sources with cv2.VideoCapture's interface, so WebcamVideoStream and
+# everything downstream (encoder, detectors, tracker) can run on recorded or
+# generated input instead of a live camera. Output size follows the
+# CAP_PROP_FRAME_WIDTH/HEIGHT the stream asks for, and with CAP_PROP_CONVERT_RGB
+# off frames come back JPEG-encoded, like a camera in MJPEG pass-through.
+# frame(index) returns the BGR pixels of frame index, or None when the source
+# has run out.
+class _ReplaySource:
+    def __init__(self, frame, fps=30.0, count=0, jpeg_quality=80):
+        self.frame = frame
+        self.fps = fps              # Delivery rate; 0 replays as fast as frames are read
+        self.count = count          # Frames to deliver before running dry; 0 for no limit
+        self.jpeg_quality = jpeg_quality
+        self.size = None            # (width, height), or None for the native size
+        self.convert_rgb = True
+        self.opened = True
+        self.frames_read = 0
+        self._started = None
+
+    def _pace(self):
+        # Frames are due on a fixed schedule from the first read, the way a
+        # camera delivers them, so a slow consumer never makes the source
+        # run slow as well
+        if self._started is None:
+            self._started = time.monotonic()
+        if self.fps:
+            delay = self._started + self.frames_read / self.fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _next(self):
+        if not self.opened or (self.count and self.frames_read >= self.count):
+            return None
+        self._pace()
+        frame = self.frame(self.frames_read)
+        if frame is None:
+            return None
+        self.frames_read += 1
+        if self.size is not None and (frame.shape[1], frame.shape[0]) != self.size:
+            frame = cv2.resize(frame, self.size, interpolation=cv2.INTER_AREA)
+        return frame
+
+    # cv2.VideoCapture interface
+
+    def read(self, image=None):
+        frame = self._next()
+        if frame is None:
+            return False, None
+        if not self.convert_rgb:
+            ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            return ok, jpeg.reshape(1, -1)
+        if image is not None and image.shape == frame.shape:
+            np.copyto(image, frame)
+            return True, image
+        return True, frame
+
+    def grab(self):
+        return self._next() is not None
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_CONVERT_RGB:
+            self.convert_rgb = bool(value)
+        elif prop == cv2.CAP_PROP_FRAME_WIDTH:
+            self.size = (int(value), self.size[1] if self.size else int(value) * 3 // 4)
+        elif prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            self.size = (self.size[0] if self.size else int(value) * 4 // 3, int(value))
+        else:
+            return False
+        return True
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH and self.size:
+            return float(self.size[0])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT and self.size:
+            return float(self.size[1])
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        return 0.0
+
+    def isOpened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+
+
+# Replays a video file, e.g. a clip from Hexa_images/, looping at the end.
+# fps=None plays at the file's own rate; fps=0 at maximum speed.
+class FileSource(_ReplaySource):
+    def __init__(self, path, fps=None, loop=True, count=0, jpeg_quality=80):
+        self.capture = cv2.VideoCapture(path)
+        if not self.capture.isOpened():
+            raise IOError(f"Cannot open video file {path}")
+        if fps is None:
+            fps = self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+        super().__init__(self._read, fps, count, jpeg_quality)
+        self.path = path
+        self.loop = loop
+        self.loops = 0
+
+    def _read(self, index):
+        grabbed, frame = self.capture.read()
+        if not grabbed and self.loop and index:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.loops += 1
+            grabbed, frame = self.capture.read()
+        return frame if grabbed else None
+
+    def release(self):
+        super().release()
+        self.capture.release()
+
+
+# Deterministic generated scene: a fixed noisy backdrop with textured patches
+# moving along fixed paths over it. Frame n depends only on seed and n, so
+# runs are repeatable on any machine, and the moving patches give the motion
+# gate and the tracker something to do.
+class SyntheticSource(_ReplaySource):
+    def __init__(self, width=640, height=480, fps=30.0, seed=0, objects=2, count=0,
+                 jpeg_quality=80):
+        super().__init__(self._render, fps, count, jpeg_quality)
+        self.size = (width, height)
+        self.seed = seed
+        self.objects = objects
+        self._scene = None
+
+    def _build(self, width, height):
+        rng = np.random.RandomState(self.seed)
+        noise = rng.randint(0, 256, (height // 8 + 1, width // 8 + 1, 3)).astype(np.uint8)
+        background = cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+        side = max(8, min(width, height) // 6)
+        patches = [rng.randint(0, 256, (side, side, 3)).astype(np.uint8)
+                   for _ in range(self.objects)]
+        # Each patch follows its own Lissajous path: (x rate, y rate, phase)
+        paths = [tuple(rng.uniform(0.2, 1.0, 2)) + (rng.uniform(0, 2 * np.pi),)
+                 for _ in range(self.objects)]
+        self._scene = ((width, height), background, patches, paths)
+
+    def _render(self, index):
+        if self._scene is None or self._scene[0] != self.size:
+            self._build(*self.size)
+        (width, height), background, patches, paths = self._scene
+        frame = background.copy()
+        t = index / 30.0  # Motion is tied to the frame number, not the clock
+        for patch, (fx, fy, phase) in zip(patches, paths):
+            side = patch.shape[0]
+            x = int((width - side) * (0.5 + 0.5 * np.sin(fx * t + phase)))
+            y = int((height - side) * (0.5 + 0.5 * np.sin(fy * t)))
+            frame[y:y + side, x:x + side] = patch
+        cv2.putText(frame, str(index), (10, height - 10), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.6, (255, 255, 255), 1)
+        return frame
+
+
+def open_source(spec, fps=None, count=0):
+    """Frame source for a HEXAPOD_CAMERA value other than a camera index.
+
+    'synthetic' generates frames; any other value is taken as a video file
+    path. fps=0 replays at maximum speed, None at the source's own rate.
+    """
+    if spec == 'synthetic':
+        return SyntheticSource(fps=30.0 if fps is None else fps, count=count)
+    return FileSource(spec, fps=fps, count=count)
+
+
+def benchmark(source, seconds=10.0, quality=70, detect=False, passthrough=True):
+    """Run capture and the /video_feed encoder (and optionally face detection) on source"""
+    from camera import WebcamVideoStream
+    from encoder import SharedJpegEncoder
+
+    camera = WebcamVideoStream(source, passthrough=passthrough)
+    encoder = SharedJpegEncoder(camera, jpeg_quality=quality)
+    worker = None
+    if detect:
+        from detection import DetectionWorker
+        cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        worker = DetectionWorker(camera.bus, lambda products: cascade.detectMultiScale(
+            products.pyramid(1), scaleFactor=1.2, minNeighbors=5, minSize=(15, 15)), level=1)
+
+    started = time.time()
+    parts = 0
+    with encoder.viewer():
+        seq = 0
+        while time.time() - started < seconds:
+            seq, part = encoder.wait(seq)
+            if part is not None:
+                parts += 1
+            elif source.count and source.frames_read >= source.count:
+                break
+    elapsed = time.time() - started
+    print(f"{source.frames_read} frames in {elapsed:.1f} s: "
+          f"capture {source.frames_read / elapsed:.1f} fps, "
+          f"stream {parts / elapsed:.1f} fps ({encoder.frames_encoded} re-encoded)")
+    if worker is not None:
+        stats = worker.stats()
+        print(f"detection {stats['frames_processed'] / elapsed:.1f} fps, "
+              f"{stats['last_duration'] * 1000:.1f} ms per frame")
+        worker.stop()
+    encoder.stop()
+    camera.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Profile the capture pipeline on repeatable input")
+    parser.add_argument('source', help="'synthetic' or a video file, e.g. Hexa_images/<clip>")
+    parser.add_argument('--max', action='store_true', help="replay as fast as possible")
+    parser.add_argument('--fps', type=float, default=None, help="replay rate")
+    parser.add_argument('--frames', type=int, default=0, help="stop after this many frames")
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--detect', action='store_true', help="also run face detection")
+    parser.add_argument('--decode', action='store_true',
+                        help="capture BGR frames and JPEG-encode them for the stream")
+    args = parser.parse_args()
+    if not args.source == 'synthetic' and not os.path.exists(args.source):
+        parser.error(f"no such file: {args.source}")
+    benchmark(open_source(args.source, 0 if args.max else args.fps, args.frames),
+              args.seconds, detect=args.detect, passthrough=not args.decode)
@@ -0,0 +1,95 @@
+import time
+import cv2
+import numpy as np
+
+
+# One tracked box and the feature points that carry it between frames.
+# Points and box are in the tracker's working (downscaled) resolution.
+class Track:
+    def __init__(self, box, points):
+        self.box = np.array(box, dtype=np.float32)  # x, y, w, h
+        self.points = points
+        self.initial_points = len(points)
+
+    @property
+    def confidence(self):
+        """Fraction of the original feature points still being followed"""
+        return len(self.points) / self.initial_points if self.initial_points else 0.0
+
+
+# Finds faces with a cascade on a downscaled pyramid level, then follows them from
+# frame to frame with sparse optical flow, which costs far less than the
+# cascade. A full detection only runs again when a track loses confidence,
+# after redetect_interval (to pick up new faces), or every detect_interval
+# while nothing is being tracked.
+class FaceTracker:
+    def __init__(self, detect, level=1, min_confidence=0.5,
+                 detect_interval=0.1, redetect_interval=1.0):
+        self.detect = detect  # detect(gray) -> boxes in gray's coordinates
+        self.level = level    # Pyramid level worked on; 1 is half size
+        self.scale = 0.5 ** level
+        self.min_confidence = min_confidence
+        self.detect_interval = detect_interval
+        self.redetect_interval = redetect_interval
+
+        self.tracks = []
+        self.lost = False  # A track was dropped since the last detection
+        self.previous = None
+        self.last_detection = 0.0
+        self.detections = 0
+        self.tracked_frames = 0
+
+    def update(self, products):
+        """Return face boxes for a FrameProducts, in full-resolution pixels"""
+        gray = products.pyramid(self.level)
+
+        if self.tracks and self.previous is not None and self.previous.shape == gray.shape:
+            self._follow(gray)
+
+        now = time.time()
+        lost = (self.lost or not self.tracks
+                or min(t.confidence for t in self.tracks) < self.min_confidence)
+        due = now - self.last_detection >= (self.detect_interval if lost else self.redetect_interval)
+        if due:
+            self.tracks = [Track(box, self._features(gray, box)) for box in self.detect(gray)]
+            self.tracks = [t for t in self.tracks if t.initial_points]
+            self.last_detection = now
+            self.lost = False
+            self.detections += 1
+        else:
+            self.tracked_frames += 1
+
+        self.previous = gray
+        return [tuple(int(round(v / self.scale)) for v in t.box) for t in self.tracks]
+
+    def _features(self, gray, box):
+        x, y, w, h = [int(v) for v in box]
+        mask = np.zeros_like(gray)
+        mask[y:y + h, x:x + w] = 255
+        points = cv2.goodFeaturesToTrack(gray, maxCorners=30, qualityLevel=0.01,
+                                         minDistance=3, mask=mask)
+        return points if points is not None else np.empty((0, 1, 2), np.float32)
+
+    def _follow(self, gray):
+        tracks = []
+        for track in self.tracks:
+            if not len(track.points):
+                continue
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(self.previous, gray, track.points, None)
+            # Track back again and keep points that return to where they
+            # started, which throws out most bad matches
+            back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous, moved, None)
+            error = np.abs(back - track.points).reshape(-1, 2).max(axis=1)
+            good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < 1.0)
+            if good.sum() < 4:
+                self.lost = True  # The next update re-detects
+                continue
+            shift = np.median((moved - track.points).reshape(-1, 2)[good], axis=0)
+            track.box[:2] += shift
+            track.points = moved[good].reshape(-1, 1, 2)
+            tracks.append(track)
+        self.tracks = tracks
+
+    def stats(self):
+        return {'detections': self.detections, 'tracked_frames': self.tracked_frames,
+                'tracks': len(self.tracks)}
@@ -0,0 +1,246 @@
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from threading import Thread, Condition
+import cv2
+import numpy as np
+from detection import DetectionResult, FrameProducts
+from framebus import FrameBus
+
+
+# Picklable face detector for worker processes. It is handed one grayscale
+# pyramid level and returns boxes in full-resolution pixels. The cascade is
+# loaded in the child, since OpenCV objects cannot be sent between processes.
+class CascadeDetector:
+    def __init__(self, cascade_path, level=1, min_size=30):
+        self.cascade_path = cascade_path
+        self.scale = 0.5 ** level
+        self.min_size = min_size
+        self.cascade = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cascade'] = None
+        return state
+
+    def __call__(self, gray):
+        if self.cascade is None:
+            cv2.setNumThreads(1)  # One core per process; the pool does the rest
+            self.cascade = cv2.CascadeClassifier(self.cascade_path)
+        min_size = max(1, int(self.min_size * self.scale))
+        faces = self.cascade.detectMultiScale(gray, scaleFactor=1.2, minNeighbors=5,
+                                              minSize=(min_size, min_size),
+                                              flags=cv2.CASCADE_SCALE_IMAGE)
+        return [tuple(int(round(v / self.scale)) for v in face) for face in faces]
+
+
+def _worker(detect, name, slot, generation, block_name, shape, tasks, results):
+    # Runs in each child: attach to its shared slot and detect until told to stop
+    block = shared_memory.SharedMemory(name=block_name)
+    frame = np.ndarray(shape, np.uint8, buffer=block.buf)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            seq, timestamp = task
+            started = time.time()
+            try:
+                objects = {name: detect(frame)}
+            except Exception as e:
+                print(f"Error in vision worker: {e}")
+                objects = {name: []}
+            results.put((slot, generation, seq, timestamp, objects, time.time() - started))
+    finally:
+        del frame
+        block.close()
+
+
+# Drop-in replacement for DetectionWorker that spreads one detector over a
+# pool of processes, so it runs on every core and outside the GIL that Flask
+# and capture share. Each frame's grayscale pyramid level goes to the
+# children through shared memory slots, one per process; only frame numbers
+# and results cross the queues. A process that dies (e.g. OpenCV crashing or
+# running out of memory) is restarted and its slot reclaimed. With a
+# pipeline, the pooled detector is its PooledDetector entry, and the other
+# detectors run here on the same FrameProducts, their results merged in.
+class ProcessDetectionWorker:
+    def __init__(self, bus, detect, processes=3, interval=0.0, gate=None,
+                 name='faces', level=1, pipeline=None):
+        self.source = bus
+        self.detect = detect      # Picklable detect(gray) -> list of objects
+        self.name = name          # Key of the results in DetectionResult.objects
+        self.level = level        # Pyramid level shipped to the children
+        self.processes = processes
+        self.interval = interval  # Minimum seconds between dispatched frames
+        self.gate = gate
+        self.pipeline = pipeline
+        self.enabled = True
+        self.stopped = False
+
+        self.results = FrameBus()
+        self.frames_processed = 0
+        self.frames_skipped = 0
+        self.last_duration = 0.0
+        self.restarts = 0
+
+        self._cond = Condition()
+        self._free = []       # Slot numbers not being worked on
+        self._blocks = []
+        self._frames = []
+        self._pool = []       # Process working on each slot
+        self._queues = []     # Task queue of each process
+        self._generations = []  # Bumped when a slot's process is replaced
+        self._local = {}      # Pipeline results of the frame in each slot
+        self._published = 0   # Results can finish out of order; keep the newest
+        self._context = mp.get_context('spawn')  # No forking of a threaded process
+        self._results = self._context.Queue()
+
+        self.thread = Thread(target=self.update, daemon=True)
+        self.thread.start()
+        self.collector = Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def _start_pool(self, shape):
+        # Sized from the first frame, like the camera's own ring
+        size = int(np.prod(shape))
+        self._blocks = [shared_memory.SharedMemory(create=True, size=size)
+                        for _ in range(self.processes)]
+        self._frames = [np.ndarray(shape, np.uint8, buffer=block.buf) for block in self._blocks]
+        self._free = list(range(self.processes))
+        self._pool = [None] * self.processes
+        self._queues = [None] * self.processes
+        self._generations = [0] * self.processes
+        for slot in range(self.processes):
+            self._spawn(slot)
+        print(f"Started {self.processes} vision worker processes")
+
+    def _spawn(self, slot):
+        self._queues[slot] = self._context.Queue()
+        self._generations[slot] += 1
+        process = self._context.Process(
+            target=_worker,
+            args=(self.detect, self.name, slot, self._generations[slot], self._blocks[slot].name,
+                  self._frames[slot].shape, self._queues[slot], self._results),
+            daemon=True)
+        process.start()
+        self._pool[slot] = process
+
+    def _reap(self):
+        # Called with _cond held: replace dead processes and free their slots,
+        # since the result that would have freed them never comes
+        for slot, process in enumerate(self._pool):
+            if process.is_alive() or self.stopped:
+                continue
+            print(f"Vision worker process exited (code {process.exitcode}), restarting it")
+            self.restarts += 1
+            self._local.pop(slot, None)
+            self._spawn(slot)
+            if slot not in self._free:
+                self._free.append(slot)
+
+    def update(self):
+        seq = 0
+        while not self.stopped and not self.source.closed:
+            # Wait for an idle process before taking a frame, so the one sent
+            # is always the newest
+            with self._cond:
+                self._reap()
+                while not (self.stopped or not self._pool or self._free):
+                    self._cond.wait(0.5)
+                    self._reap()
+            if self.stopped:
+                break
+
+            new_seq, frame = self.source.wait(seq, 1.0)
+            if frame is None:
+                continue
+            with frame:
+                if seq:
+                    self.frames_skipped += new_seq - seq - 1
+                seq = new_seq
+                if not self.enabled:
+                    continue
+                products = FrameProducts(frame, self.level)
+                if self.gate is not None and not self.gate.update(products):
+                    continue
+                try:
+                    local = self.pipeline(products) if self.pipeline is not None else {}
+                except Exception as e:
+                    print(f"Error in vision worker: {e}")
+                    continue
+                if self.pipeline is not None and not self.pipeline.enabled.get(self.name):
+                    # Only the pipeline's own detectors are on; no pool round trip
+                    self.frames_processed += 1
+                    self._publish(seq, frame.timestamp, local)
+                    continue
+                image = products.pyramid(self.level)
+                if not self._pool:
+                    self._start_pool(image.shape)
+                if image.shape != self._frames[0].shape:
+                    continue  # The camera changed resolution
+                with self._cond:
+                    slot = self._free.pop()
+                    self._local[slot] = local
+                np.copyto(self._frames[slot], image)
+                self._queues[slot].put((seq, frame.timestamp))
+
+            if self.interval:
+                time.sleep(self.interval)
+
+    def _collect(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                break
+            slot, generation, seq, timestamp, objects, duration = item
+            with self._cond:
+                # A dead process's slot was already reclaimed by _reap()
+                if generation == self._generations[slot]:
+                    self._free.append(slot)
+                    objects.update(self._local.pop(slot, {}))
+                self._cond.notify_all()
+            self.frames_processed += 1
+            self.last_duration = duration
+            self._publish(seq, timestamp, objects)
+
+    def _publish(self, seq, timestamp, objects):
+        with self._cond:
+            if seq <= self._published:
+                return
+            self._published = seq
+        self.results.publish(DetectionResult(seq, timestamp, objects, time.time()), timestamp)
+
+    def latest(self):
+        """Return the most recent DetectionResult, or None"""
+        return self.results.latest()[1]
+
+    def stats(self):
+        stats = {'frames_processed': self.frames_processed,
+                 'frames_skipped': self.frames_skipped,
+                 'last_duration': self.last_duration,
+                 'processes': len(self._pool),
+                 'restarts': self.restarts}
+        if self.gate is not None:
+            stats.update(self.gate.stats())
+        return stats
+
+    def stop(self):
+        with self._cond:
+            self.stopped = True
+            self._cond.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout=1.0)
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._pool:
+            process.join(timeout=2.0)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+        self.collector.join(timeout=1.0)
+        self.results.close()
+        self._frames = []
+        for block in self._blocks:
+            block.close()
+            block.unlink()